@@ -0,0 +1,146 @@
+import os
+import glob
+import json
+import time
+import argparse
+import subprocess
+import create_tables
+from create_tables import create_indexes, finalize_tables
+from sql_queries import lookup_index_queries
+from metrics import metrics
+from etl import read_config, open_database, extract_data_from_file, build_song_lookup, \
+    refresh_aggregates, transform_song_data, transform_log_data
+
+def count_files(filepath):
+    """
+    Counts the JSON files under `filepath` and their total size in bytes.
+    """
+    files = glob.glob(os.path.join(filepath, '**', '*.json'), recursive=True)
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+def count_rows(cur, tables):
+    """
+    Counts the rows currently in `tables`.
+    """
+    total = 0
+    for table in tables:
+        cur.execute('SELECT count(*) FROM {};'.format(table))
+        total += cur.fetchone()[0]
+    return total
+
+def run_stage(name, db, filepath, tables, func):
+    """
+    Runs one ETL pass and measures it.
+
+    Args:
+        name (str): Name of the stage in the report.
+        db (Database object): The database object to use for database operations.
+        filepath (str): Directory holding the stage's JSON files.
+        tables (list): Tables the stage loads, used to count the rows it adds.
+        func (function): Runs the pass.
+
+    Returns:
+        dict: Wall time, files/sec, rows/sec and round trips of the stage, with the
+        etl.py stage metrics of the pass.
+    """
+    num_files, num_bytes = count_files(filepath)
+    rows_before = count_rows(db.cur, tables)
+
+    # statements, COPYs and commits are counted by the connections of `Database`
+    metrics.reset()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    stage_metrics = metrics.snapshot()
+    stage_round_trips = sum(counters['statements'] for counters in stage_metrics.values())
+
+    rows = count_rows(db.cur, tables) - rows_before
+    return {
+        'stage': name,
+        'seconds': round(elapsed, 3),
+        'files': num_files,
+        'bytes': num_bytes,
+        'rows': rows,
+        'files_per_sec': round(num_files / elapsed, 1) if elapsed else None,
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+        'round_trips': stage_round_trips,
+        'etl_stages': stage_metrics
+    }
+
+def git_commit():
+    """
+    Returns the current git commit, so results can be compared across commits.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """
+    - Recreates the sparkify database with `create_tables.py`, passing on `--bootstrap`
+      and `--partition`.
+
+    - Runs the song and log passes of `etl.py` on the given data directory, using the [ETL]
+      settings in config.ini.
+
+    - Prints files/sec, rows/sec and round trips per stage and writes them as JSON.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the create_tables.py + etl.py pipeline.')
+    parser.add_argument('--data-dir', default='data', help='directory with song_data/ and log_data/, see generate_data.py')
+    parser.add_argument('--bootstrap', action='store_true', help='create the tables with `create_tables.py --bootstrap`')
+    parser.add_argument('--partition', action='store_true', help='create the tables with `create_tables.py --partition`')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    config_data = read_config()
+    song_path = os.path.join(args.data_dir, 'song_data')
+    log_path = os.path.join(args.data_dir, 'log_data')
+
+    start = time.perf_counter()
+    create_args = []
+    if args.bootstrap:
+        create_args.append('--bootstrap')
+    if args.partition:
+        create_args.append('--partition')
+    create_tables.main(create_args)
+    results = [{'stage': 'create_tables', 'seconds': round(time.perf_counter() - start, 3)}]
+
+    db = open_database(config_data)
+    try:
+        def song_pass():
+            extract_data_from_file(db, song_path, transform_song_data)
+            if db.bootstrap:
+                create_indexes(db.cur, db.conn, lookup_index_queries)
+            db.song_lookup = build_song_lookup(db, config_data)
+
+        def log_pass():
+            extract_data_from_file(db, log_path, transform_log_data)
+            refresh_aggregates(db)
+            if db.bootstrap:
+                finalize_tables(db.cur, db.conn)
+
+        results.append(run_stage('song_data', db, song_path, ['songs', 'artists'], song_pass))
+        results.append(run_stage('log_data', db, log_path, ['time', 'users', 'songplays'], log_pass))
+    finally:
+        db.close()
+
+    print('\n{:<14}{:>10}{:>10}{:>12}{:>12}{:>14}'.format('stage', 'seconds', 'files', 'files/sec', 'rows/sec', 'round trips'))
+    for result in results:
+        print('{:<14}{:>10}{:>10}{:>12}{:>12}{:>14}'.format(
+            result['stage'], result['seconds'], result.get('files', ''), result.get('files_per_sec', ''),
+            result.get('rows_per_sec', ''), result.get('round_trips', '')))
+
+    report = {
+        'commit': git_commit(),
+        'data_dir': args.data_dir,
+        'settings': {key: value for key, value in config_data.items() if not key.startswith('db_')},
+        'stages': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import psycopg2
+import argparse
 import configparser
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, create_index_queries, \
+    create_constraint_queries, star_table_create_queries, songplay_table_create, \
+    songplay_partitioned_table_create, bootstrap_select, partitioned_select, unlogged_tables_select, \
+    set_logged_table, analyze_tables
 
 def read_config():
     # Create a ConfigParser object
@@ -16,6 +20,8 @@ def read_config():
     db_username = config.get('Database', 'username')
     db_pwd = config.get('Database', 'pwd')
     db_port = config.get('Database', 'port_id')
+    sink = config.get('ETL', 'sink', fallback='postgres')
+    duckdb_path = config.get('ETL', 'duckdb_path', fallback='sparkifydb.duckdb')
  
     # Return a dictionary with the retrieved values
     config_values = {
@@ -24,7 +30,9 @@ def read_config():
         'db_host': db_host,
         'db_username': db_username,
         'db_pwd': db_pwd,
-        'db_port': db_port
+        'db_port': db_port,
+        'sink': sink,
+        'duckdb_path': duckdb_path
     }
  
     return config_values
@@ -80,15 +88,85 @@ def drop_tables(cur, conn):
         cur.execute(query)
         conn.commit()
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, bootstrap=False, partition=False):
     """
     Creates each table using the queries in `create_table_queries` list. 
+
+    Args:
+        cur (cursor object): The cursor object to execute SQL queries.
+        conn (connection object): The connection object to the database.
+        bootstrap (bool): Whether to create the star tables unlogged, with primary keys only,
+            for a fast first load. The ON CONFLICT merges need the primary keys.
+        partition (bool): Whether to create songplays range partitioned by month of start_time.
+            Partitioned tables cannot be unlogged, their partitions are in bootstrap mode.
     """
     for query in create_table_queries:
+        if partition and query is songplay_table_create:
+            query = songplay_partitioned_table_create
+        elif bootstrap and query in star_table_create_queries:
+            query = query.replace('CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+        cur.execute(query)
+        conn.commit()
+
+def create_indexes(cur, conn, queries=create_index_queries):
+    """
+    Creates the indexes using the queries in `create_index_queries` list: the lookup indexes
+    backing the songs/artists match done for every songplay, and the songplays indexes on
+    (user_id, start_time) and song_id.
+
+    Args:
+        cur (cursor object): The cursor object to execute SQL queries.
+        conn (connection object): The connection object to the database.
+        queries (list): Index queries to run, by default all of them.
+    """
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
-def main():
+def create_constraints(cur, conn):
+    """
+    Adds the songplays foreign keys using the queries in `create_constraint_queries` list.
+    """
+    for query in create_constraint_queries:
+        cur.execute(query)
+        conn.commit()
+
+def is_bootstrap_schema(cur):
+    """
+    Returns whether the tables were created by `create_tables.py --bootstrap` and not finalized yet.
+    """
+    cur.execute(bootstrap_select)
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+def is_partitioned_songplays(cur):
+    """
+    Returns whether songplays was created by `create_tables.py --partition`.
+    """
+    cur.execute(partitioned_select)
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+def finalize_tables(cur, conn):
+    """
+    Finishes a bootstrap load: switches the star tables and songplays partitions to logged, builds the indexes,
+    adds and validates the foreign keys and refreshes the planner statistics. Everything runs
+    in one transaction, so a failed run leaves the tables in bootstrap mode to be finalized
+    by the next one.
+
+    Args:
+        cur (cursor object): The cursor object to execute SQL queries.
+        conn (connection object): The connection object to the database.
+    """
+    cur.execute(unlogged_tables_select)
+    for (table,) in cur.fetchall():
+        cur.execute(set_logged_table.format(table))
+    for query in create_index_queries + create_constraint_queries:
+        cur.execute(query)
+    cur.execute(analyze_tables)
+    conn.commit()
+
+def main(argv=None):
     """
     - Drops (if exists) and Creates the sparkify database. 
     
@@ -98,14 +176,43 @@ def main():
     - Drops all the tables.  
     
     - Creates all tables needed. 
+
+    - Creates the indexes used to resolve and query songplays and the songplays foreign keys. 
+
+    - With `--partition`, creates songplays range partitioned by month of start_time. `etl.py`
+      creates a partition for every month it loads.
+
+    - With `--bootstrap`, creates the star tables unlogged, with primary keys only, instead.
+      `etl.py` then builds the indexes after the song data, and switches the tables to logged
+      and adds the foreign keys after the log data.
     
     - Finally, closes the connection. 
+
+    With `sink = duckdb` in config.ini, the DuckDB file is recreated instead, see `duckdb_sink.py`.
+
+    Args:
+        argv (list): Command line arguments, defaults to `sys.argv`.
     """
+    parser = argparse.ArgumentParser(description='Create the sparkify database.')
+    parser.add_argument('--bootstrap', action='store_true',
+                        help='create unlogged tables without indexes and foreign keys for a fast first load')
+    parser.add_argument('--partition', action='store_true',
+                        help='range partition songplays by month of start_time')
+    args = parser.parse_args(argv)
+
+    config_data = read_config()
+    if config_data['sink'] == 'duckdb':
+        from duckdb_sink import create_database as create_duckdb_database
+        create_duckdb_database(config_data['duckdb_path'])
+        return
 
     cur, conn = create_database()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, bootstrap=args.bootstrap, partition=args.partition)
+    if not args.bootstrap:
+        create_indexes(cur, conn)
+        create_constraints(cur, conn)
     conn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import os
+import re
+import argparse
+import tempfile
+import duckdb
+from sql_queries import create_table_queries, songplay_capture_create, songplay_table_merge, \
+    songplay_table_resolved_merge, songplay_delta_capture
+from metrics import metrics
+
+# target table and columns of a `COPY ... FROM STDIN` query from `sql_queries.py`
+COPY_TARGET = re.compile(r'COPY\s+(\w+)\s*\(([^)]*)\)\s+FROM STDIN', re.IGNORECASE)
+LIKE_TABLE = re.compile(r'CREATE TABLE (\w+)\s*\(LIKE (\w+)\);')
+TRUNCATE_TABLES = re.compile(r'^\s*TRUNCATE\s+([\w\s,]+);?\s*$', re.IGNORECASE)
+FLOAT_TYPE = re.compile(r'\bfloat\b', re.IGNORECASE)
+
+# star tables in foreign key order
+STAR_TABLES = ['time', 'users', 'songs', 'artists', 'songplays']
+
+def duckdb_table_query(query):
+    """
+    Adapts a CREATE TABLE query from `sql_queries.py` to DuckDB, which has no unlogged
+    tables, no `LIKE` clause and no triggers. `float` is 8 bytes in PostgreSQL but 4 in
+    DuckDB, so it becomes DOUBLE to keep song lengths exact for the songplay matching.
+
+    Args:
+        query (str): A query from `create_table_queries`.
+
+    Returns:
+        str: The DuckDB query, or None when the query has no DuckDB equivalent.
+    """
+    if query is songplay_capture_create:
+        return None
+    query = query.replace('CREATE UNLOGGED TABLE', 'CREATE TABLE')
+    query = FLOAT_TYPE.sub('DOUBLE', query)
+    return LIKE_TABLE.sub(r'CREATE TABLE \1 AS SELECT * FROM \2 LIMIT 0;', query)
+
+def create_database(path):
+    """
+    - Replaces the DuckDB file at `path` with an empty one.
+
+    - Creates the tables of `create_table_queries`. Indexes and foreign keys are left out:
+      DuckDB scans columns without them, and its indexes slow down bulk upserts.
+
+    Args:
+        path (str): Path of the DuckDB database file.
+    """
+    for stale in (path, path + '.wal'):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    con = duckdb.connect(path)
+    for query in create_table_queries:
+        query = duckdb_table_query(query)
+        if query:
+            con.execute(query)
+    con.close()
+
+class DuckDBCursor:
+    """
+    Cursor running the psycopg2 style queries of `sql_queries.py` on DuckDB. DataFrames are
+    inserted directly instead of through COPY, and as DuckDB has no triggers the songplays
+    merges capture their new rows in songplays_delta themselves.
+    """
+    def __init__(self, con):
+        """
+        Initializes the cursor on a DuckDB connection.
+
+        Args:
+            con (DuckDBPyConnection): The DuckDB connection.
+        """
+        self.con = con
+
+    def execute(self, query, params=None):
+        """
+        Executes a query written with `%s` placeholders.
+
+        Args:
+            query (str): A query from `sql_queries.py`.
+            params (sequence): Query parameters.
+        """
+        metrics.add(statements=1)
+        if query in (songplay_table_merge, songplay_table_resolved_merge):
+            # only the batch's new rows are captured, without scanning songplays
+            new_rows = self.con.execute(query.rstrip().rstrip(';') + '\nRETURNING *;').arrow()
+            self.con.register('songplays_new', new_rows)
+            try:
+                self.con.execute(songplay_delta_capture)
+            finally:
+                self.con.unregister('songplays_new')
+        elif TRUNCATE_TABLES.match(query):
+            # DuckDB truncates one table per statement
+            for table in TRUNCATE_TABLES.match(query).group(1).split(','):
+                self.con.execute('TRUNCATE {};'.format(table.strip()))
+        else:
+            self.con.execute(query.replace('%s', '?'), params)
+
+    def fetchone(self):
+        return self.con.fetchone()
+
+    def fetchall(self):
+        return self.con.fetchall()
+
+    def copy_dataframe(self, df, copy_query):
+        """
+        Inserts a DataFrame into the table and columns of a COPY query, scanning the
+        DataFrame in place.
+
+        Args:
+            df (DataFrame): Rows in the column order of the COPY query.
+            copy_query (str): A `COPY ... FROM STDIN` query from `sql_queries.py`.
+        """
+        table, columns = COPY_TARGET.search(copy_query).groups()
+        metrics.add(statements=1)
+        self.con.register('copy_frame', df)
+        try:
+            self.con.execute('INSERT INTO {} ({}) SELECT * FROM copy_frame;'.format(table, columns))
+        finally:
+            self.con.unregister('copy_frame')
+
+    def close(self):
+        pass
+
+class DuckDBConnection:
+    """
+    Connection to a DuckDB file behaving like a psycopg2 connection: a transaction is always
+    open, and `commit` starts the next one.
+    """
+    def __init__(self, path):
+        """
+        Opens the DuckDB file and starts a transaction.
+
+        Args:
+            path (str): Path of the DuckDB database file.
+        """
+        self.con = duckdb.connect(path)
+        self.con.begin()
+
+    def cursor(self):
+        return DuckDBCursor(self.con)
+
+    def commit(self):
+        metrics.add(statements=1)
+        self.con.commit()
+        self.con.begin()
+
+    def rollback(self):
+        self.con.rollback()
+        self.con.begin()
+
+    def close(self):
+        """
+        Closes the connection, rolling back the open transaction.
+        """
+        self.con.close()
+
+def export_database(path, directory):
+    """
+    Exports every table of the DuckDB file as Parquet, along with the schema.sql and load.sql
+    scripts DuckDB uses to import it again.
+
+    Args:
+        path (str): Path of the DuckDB database file.
+        directory (str): Directory to export to.
+    """
+    con = duckdb.connect(path, read_only=True)
+    try:
+        con.execute("EXPORT DATABASE '{}' (FORMAT parquet);".format(directory))
+    finally:
+        con.close()
+
+def push_to_postgres(path, db):
+    """
+    Copies the star tables of the DuckDB file into Postgres, through a CSV file per table.
+    The Postgres tables must be empty, freshly created by `create_tables.py`. The songplays
+    are captured in songplays_delta like any other insert, so `refresh_aggregates` builds the
+    Postgres aggregate tables from them.
+
+    Args:
+        path (str): Path of the DuckDB database file.
+        db (Database object): The Postgres database to push to.
+
+    Returns:
+        dict: Number of rows copied per table.
+    """
+    from etl import create_songplay_partitions
+
+    con = duckdb.connect(path, read_only=True)
+    rows = {}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for table in STAR_TABLES:
+                if table == 'songplays' and db.partitioned:
+                    # one start time per day is enough to create every monthly partition
+                    days = con.execute('SELECT DISTINCT start_time // 86400000 * 86400000 AS ts FROM songplays;').df()
+                    create_songplay_partitions(db, days['ts'])
+
+                csv_path = os.path.join(directory, table + '.csv')
+                con.execute("COPY {} TO '{}' (FORMAT csv, HEADER false, NULLSTR '\\N');".format(table, csv_path))
+                with open(csv_path) as f:
+                    db.cur.copy_expert("COPY {} FROM STDIN WITH (FORMAT csv, NULL '\\N');".format(table), f)
+                rows[table] = db.cur.rowcount
+            db.conn.commit()
+    finally:
+        con.close()
+    return rows
+
+def main():
+    """
+    - `export DIRECTORY` writes the tables of the DuckDB file set in config.ini as Parquet.
+
+    - `push` copies its star tables into the Postgres database set in config.ini, which has
+      to be freshly created with the postgres sink, and refreshes the aggregate tables there.
+    """
+    from etl import read_config, Database, refresh_aggregates
+
+    parser = argparse.ArgumentParser(description='Export or push the DuckDB sink of etl.py.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='export every table as Parquet')
+    export.add_argument('directory', help='directory to export to')
+    commands.add_parser('push', help='copy the star tables into the Postgres database')
+    args = parser.parse_args()
+
+    config_data = read_config()
+    if args.command == 'export':
+        export_database(config_data['duckdb_path'], args.directory)
+        print('{} exported to {}'.format(config_data['duckdb_path'], args.directory))
+    else:
+        db = Database(config_data)
+        try:
+            for table, count in push_to_postgres(config_data['duckdb_path'], db).items():
+                print('{}: {} rows'.format(table, count))
+            print("Aggregates refreshed with {} new songplays.".format(refresh_aggregates(db)))
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,32 @@
 import os
+import re
+import sys
+import json
 import glob
+import mmap
+import pickle
+import traceback
 import configparser
+from collections import deque
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO, BytesIO
 import psycopg2
 import pandas as pd
 from sql_queries import *
+from metrics import metrics, CountingConnection
+from parse_cache import ParseCache, parse_cached, hash_file
+from create_tables import create_indexes, is_bootstrap_schema, is_partitioned_songplays, finalize_tables
+
+# version of the parse and transform output, bump it when a transform changes so that
+# batches in the parsed-file cache are parsed again
+TRANSFORM_VERSION = '1'
+
+NON_WHITESPACE = re.compile(rb'\S')
+
+# song files loaded per batch by the DuckDB sink, which has no per-row insert path
+DUCKDB_SONG_BATCH_SIZE = 500
 
 def read_config():
     """
@@ -26,6 +49,27 @@ def read_config():
     db_username = config.get('Database', 'username')
     db_pwd = config.get('Database', 'pwd')
     db_port = config.get('Database', 'port_id')
+
+    # ETL settings are optional so existing config files keep working
+    load_mode = config.get('ETL', 'load_mode', fallback='row')
+    song_lookup = config.get('ETL', 'song_lookup', fallback='database')
+    song_lookup_snapshot = config.get('ETL', 'song_lookup_snapshot', fallback='')
+    workers = config.getint('ETL', 'workers', fallback=1)
+    queue_size = config.getint('ETL', 'queue_size', fallback=0)
+    commit_files = config.getint('ETL', 'commit_files', fallback=1)
+    commit_rows = config.getint('ETL', 'commit_rows', fallback=0)
+    incremental = config.getboolean('ETL', 'incremental', fallback=False)
+    chunk_size = config.getint('ETL', 'chunk_size', fallback=0)
+    prepare_statements = config.getboolean('ETL', 'prepare_statements', fallback=False)
+    song_batch_size = config.getint('ETL', 'song_batch_size', fallback=0)
+    split_size = config.getint('ETL', 'split_size', fallback=0)
+    cache_dir = config.get('ETL', 'cache_dir', fallback='')
+    cache_max_mb = config.getint('ETL', 'cache_max_mb', fallback=1024)
+    run_report = config.get('ETL', 'run_report', fallback='')
+    prometheus_textfile = config.get('ETL', 'prometheus_textfile', fallback='')
+    profile_dir = config.get('ETL', 'profile_dir', fallback='')
+    sink = config.get('ETL', 'sink', fallback='postgres')
+    duckdb_path = config.get('ETL', 'duckdb_path', fallback='sparkifydb.duckdb')
  
     # Return a dictionary with the retrieved values
     config_values = {
@@ -34,30 +78,106 @@ def read_config():
         'db_host': db_host,
         'db_username': db_username,
         'db_pwd': db_pwd,
-        'db_port': db_port
+        'db_port': db_port,
+        'load_mode': load_mode,
+        'song_lookup': song_lookup,
+        'song_lookup_snapshot': song_lookup_snapshot,
+        'workers': workers,
+        'queue_size': queue_size,
+        'commit_files': commit_files,
+        'commit_rows': commit_rows,
+        'incremental': incremental,
+        'chunk_size': chunk_size,
+        'prepare_statements': prepare_statements,
+        'song_batch_size': song_batch_size,
+        'split_size': split_size,
+        'cache_dir': cache_dir,
+        'cache_max_mb': cache_max_mb,
+        'run_report': run_report,
+        'prometheus_textfile': prometheus_textfile,
+        'profile_dir': profile_dir,
+        'sink': sink,
+        'duckdb_path': duckdb_path
     }
  
     return config_values
 
 class Database:
     """
-    Manages the database connection and cursor.
+    Manages the database connection and cursor, along with the load settings used by the ETL run.
     """
-    def __init__(self, config_data):
+    def __init__(self, config_data, connection_factory=CountingConnection):
         """
         Initializes the database connection and cursor using provided configuration.
 
         Args:
             config_data (dict): Configuration data containing database connection parameters.
+            connection_factory (class): psycopg2 connection class, by default one counting statements in `metrics`.
         """
         self.conn = psycopg2.connect(
             host= config_data['db_host'],
             dbname = config_data['db_name'],
             user = config_data['db_username'],
             password = config_data['db_pwd'],
-            port = config_data['db_port']
+            port = config_data['db_port'],
+            connection_factory = connection_factory
         )
         self.cur = self.conn.cursor()
+        # statements from `prepared_statements` are prepared once on the connection
+        self.statements = {}
+        if config_data.get('prepare_statements', False):
+            for name, query in prepared_statements.items():
+                self.statements[query] = prepare_statement(name, query)
+                self.cur.execute(self.statements[query][0])
+            self.conn.commit()
+
+        self.configure(config_data)
+        # schema options of `create_tables.py`, and the songplays partitions created during this run
+        self.bootstrap = is_bootstrap_schema(self.cur)
+        self.partitioned = is_partitioned_songplays(self.cur)
+        self.songplay_partitions = set()
+
+    def configure(self, config_data):
+        """
+        Reads the load settings of the ETL run and initializes the run state.
+
+        Args:
+            config_data (dict): Configuration data containing the ETL settings.
+        """
+        self.load_mode = config_data.get('load_mode', 'row')
+        self.song_lookup = None
+        self.workers = config_data.get('workers', 1)
+        # parsed files waiting to be loaded, two per worker unless configured
+        self.queue_size = config_data.get('queue_size') or 2 * self.workers
+        # a transaction is committed after this many files or rows, whichever comes first
+        self.commit_files = config_data.get('commit_files', 1)
+        self.commit_rows = config_data.get('commit_rows', 0)
+        self.incremental = config_data.get('incremental', False)
+        self.chunk_size = config_data.get('chunk_size', 0)
+        self.song_batch_size = config_data.get('song_batch_size', 0)
+        self.split_size = config_data.get('split_size', 0)
+        # parsed batches are cached on disk when a cache directory is set
+        self.parse_cache = None
+        if config_data.get('cache_dir'):
+            self.parse_cache = ParseCache(config_data['cache_dir'], config_data.get('cache_max_mb', 1024) * 1024 * 1024,
+                                          TRANSFORM_VERSION)
+        # start times of the previous batch, files are loaded in time order so that is where
+        # repeated start times come from; older repeats are left to the time merge's ON CONFLICT
+        self.previous_start_times = set()
+        self.user_cache = UserCache()
+
+    def execute(self, query, params=None):
+        """
+        Executes a query, through its prepared statement when one exists.
+
+        Args:
+            query (str): A query from `sql_queries.py`.
+            params (sequence): Query parameters.
+        """
+        if query in self.statements:
+            self.cur.execute(self.statements[query][1], params)
+        else:
+            self.cur.execute(query, params)
 
     def close(self):
         """
@@ -65,150 +185,1070 @@ class Database:
         """
         self.conn.close()
 
+class DuckDBDatabase(Database):
+    """
+    Embedded DuckDB sink with the same interface as `Database`, loading the star schema of
+    `sql_queries.py` into a local file. Batches are always bulk loaded, DuckDB reading the
+    DataFrames directly, and song files are loaded `DUCKDB_SONG_BATCH_SIZE` at a time unless
+    `song_batch_size` sets a larger batch.
+    """
+    def __init__(self, config_data):
+        """
+        Opens the DuckDB file created by `create_tables.py` with `sink = duckdb`.
+
+        Args:
+            config_data (dict): Configuration data containing `duckdb_path` and the ETL settings.
+        """
+        from duckdb_sink import DuckDBConnection
+
+        self.statements = {}
+        self.conn = DuckDBConnection(config_data['duckdb_path'])
+        self.cur = self.conn.cursor()
+        self.configure(config_data)
+        # the songplays merges capture new songplays for the aggregates, row inserts cannot
+        self.load_mode = 'copy'
+        # one small insert and commit per song file would dominate the song pass
+        self.song_batch_size = max(self.song_batch_size, DUCKDB_SONG_BATCH_SIZE)
+        self.bootstrap = False
+        self.partitioned = False
+        self.songplay_partitions = set()
+
+    def close(self):
+        """
+        Closes the DuckDB file.
+        """
+        self.conn.close()
+
+def open_database(config_data):
+    """
+    Opens the sink set by `sink` in config.ini.
+
+    Args:
+        config_data (dict): Configuration data containing the database settings.
+
+    Returns:
+        Database object: `Database` for Postgres, `DuckDBDatabase` for DuckDB.
+    """
+    if config_data.get('sink', 'postgres') == 'duckdb':
+        return DuckDBDatabase(config_data)
+    return Database(config_data)
+
+def prepare_statement(name, query):
+    """
+    Turns a `%s` parameterized query into a server-side prepared statement.
+
+    Args:
+        name (str): Name of the prepared statement.
+        query (str): Query using `%s` placeholders.
+
+    Returns:
+        tuple: (prepare_sql, execute_sql) where `execute_sql` runs the statement with `%s` parameters.
+    """
+    parts = query.strip().rstrip(';').split('%s')
+    num_params = len(parts) - 1
+
+    body = parts[0] + ''.join('${}{}'.format(i, part) for i, part in enumerate(parts[1:], 1))
+    prepare_sql = 'PREPARE {} AS {};'.format(name, body)
+    if num_params:
+        execute_sql = 'EXECUTE {} ({});'.format(name, ', '.join(['%s'] * num_params))
+    else:
+        execute_sql = 'EXECUTE {};'.format(name)
+
+    return prepare_sql, execute_sql
+
+class SongLookup:
+    """
+    In-memory hash index from (song title, artist name, duration) to (song_id, artist_id),
+    used by the log pass instead of querying the songs and artists tables for every songplay.
+    """
+    def __init__(self, index=None):
+        """
+        Initializes the lookup with an optional prebuilt index.
+
+        Args:
+            index (dict): Mapping of (title, artist name, duration) to (song_id, artist_id).
+        """
+        self.index = index or {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Builds the lookup from the songs and artists tables with a single query.
+
+        Args:
+            cur (cursor object): Database cursor to execute queries.
+
+        Returns:
+            SongLookup: The populated lookup.
+        """
+        cur.execute(song_lookup_select)
+        return cls({(title, name, duration): (song_id, artist_id)
+                    for title, name, duration, song_id, artist_id in cur.fetchall()})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the lookup from a snapshot written by `save`.
+
+        Args:
+            path (str): Path to the snapshot file.
+
+        Returns:
+            SongLookup: The populated lookup.
+        """
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+    def save(self, path):
+        """
+        Writes the index to a snapshot file so later runs can skip rebuilding it.
+
+        Args:
+            path (str): Path to the snapshot file.
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self.index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self, title, artist, duration):
+        """
+        Resolves a song play to its song and artist ids.
+
+        Returns:
+            tuple: (song_id, artist_id), or (None, None) when the song is unknown.
+        """
+        result = self.index.get((title, artist, duration))
+        if result is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return result
+
+    def memory_usage(self):
+        """
+        Estimates the memory held by the index, including its keys and values.
+
+        Returns:
+            int: Approximate size in bytes.
+        """
+        size = sys.getsizeof(self.index)
+        for key, value in self.index.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+            size += sum(sys.getsizeof(item) for item in key + value)
+        return size
+
+    def stats(self):
+        """
+        Returns the index size and its hit/miss counts as a dictionary.
+        """
+        return {'entries': len(self.index), 'bytes': self.memory_usage(), 'hits': self.hits, 'misses': self.misses}
+
+    def report(self):
+        """
+        Returns a one-line summary of the index size and its hit/miss counts.
+        """
+        return 'Song lookup: {} entries, {:.1f} KiB, {} hits, {} misses.'.format(
+            len(self.index), self.memory_usage() / 1024, self.hits, self.misses)
+
+class UserCache:
+    """
+    Remembers the level last written for each user during the run, so that only new
+    users and free/paid transitions are sent to the users table.
+    """
+    def __init__(self):
+        """
+        Initializes an empty cache and its counters.
+        """
+        self.levels = {}
+        self.hits = 0
+        self.skips = 0
+        self.writes = 0
+
+    def filter(self, user_df):
+        """
+        Keeps the user rows that change the users table and records their levels.
+
+        Args:
+            user_df (DataFrame): DataFrame containing user data.
+
+        Returns:
+            DataFrame: The latest row of each new user or user whose level changed.
+        """
+        # only the last row of a user decides its level, like the row-by-row upsert does
+        user_df = user_df.drop_duplicates('userId', keep='last')
+        user_ids = pd.to_numeric(user_df['userId']).tolist()
+
+        changed = []
+        for user_id, level in zip(user_ids, user_df['level']):
+            cached = self.levels.get(user_id)
+            if cached is not None:
+                self.hits += 1
+            if cached == level:
+                self.skips += 1
+                changed.append(False)
+            else:
+                self.levels[user_id] = level
+                self.writes += 1
+                changed.append(True)
+
+        return user_df[changed]
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary.
+        """
+        return {'users': len(self.levels), 'hits': self.hits, 'skips': self.skips, 'writes': self.writes}
+
+    def report(self):
+        """
+        Returns a one-line summary of the cache counters.
+        """
+        return 'User cache: {} users, {} hits, {} skipped, {} written.'.format(
+            len(self.levels), self.hits, self.skips, self.writes)
+
+def build_song_lookup(db, config_data):
+    """
+    Builds the in-memory song lookup once the song pass is finished.
+
+    With `song_lookup = memory` the index is read from the database and, if
+    `song_lookup_snapshot` is set, written to that file. With `song_lookup = snapshot`
+    it is loaded from the snapshot instead.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        config_data (dict): Configuration data containing the ETL settings.
+
+    Returns:
+        SongLookup: The lookup, or None when songplays are resolved by the database.
+    """
+    mode = config_data.get('song_lookup', 'database')
+    snapshot = config_data.get('song_lookup_snapshot', '')
+
+    if mode == 'snapshot':
+        return SongLookup.load(snapshot)
+
+    if mode == 'memory':
+        lookup = SongLookup.from_database(db.cur)
+        if snapshot:
+            lookup.save(snapshot)
+        return lookup
+
+    return None
+
 def extract_data_from_file(db, filepath, func):
     """
     Extracts data from JSON files located in a specified directory and processes each file using a given function.
 
+    Files are parsed by `func`'s parse stage, in worker processes when `workers` is above one,
+    and loaded through a single connection in file order. Every commit also records the files
+    it loaded as a checkpoint, so a run that fails part way skips them when it is run again.
+    With `incremental` enabled, files recorded in the manifest with the same content are skipped.
+    Transforms with a batch stage parse and load `song_batch_size` files at a time instead.
+    Transforms with a range stage can split files into `split_size` byte ranges, so several
+    workers parse one large file.
+
     Args:
         db (Database object): The database object to use for database operations.
         filepath (str): Path to the directory containing JSON files.
         func (function): The function to process each JSON file.
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, '*.json'))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+    with metrics.stage('discover'):
+        # get all files matching extension from directory
+        all_files = []
+        for root, dirs, files in os.walk(filepath):
+            files = glob.glob(os.path.join(root, '*.json'))
+            for f in files:
+                all_files.append(os.path.abspath(f))
+
+        # a stable order lets an interrupted run resume from its checkpoint
+        all_files.sort()
+
+        # get total number of files found
+        num_files = len(all_files)
+        metrics.add(rows_in=num_files)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        # only load files that are new or changed since they were last loaded
+        file_stats = {}
+        if db.incremental:
+            all_files, file_stats = select_changed_files(db, all_files)
+            num_files = len(all_files)
+            print('{} new or changed files to load.'.format(num_files))
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+        # skip the files committed by an earlier, interrupted run, files added since then are
+        # loaded even when they sort before them
+        num_done = 0
+        loaded_files = read_checkpoint(db, filepath)
+        if loaded_files:
+            all_files = [f for f in all_files if os.path.relpath(f, filepath) not in loaded_files]
+            num_done = num_files - len(all_files)
+            print('Resuming after {} files loaded by a previous run.'.format(num_done))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files,1):
-        func(db.cur, datafile)
+        metrics.add(rows_out=len(all_files))
+
+    stages = TRANSFORM_STAGES[func]
+    load_func = stages['load']
+
+    # each unit of work is a list of files parsed together, then loaded as one or more batches
+    if stages.get('parse_range') and db.split_size:
+        # split files into line aligned byte ranges parsed by the workers, loaded in file and range order
+        with metrics.stage('discover'):
+            file_ranges = [line_ranges(datafile, db.split_size) for datafile in all_files]
+        parsed_ranges = iter_parsed_files([byte_range for ranges in file_ranges for byte_range in ranges],
+                                          cached(db, stages['parse_range']), db.workers, db.queue_size)
+        parsed_units = (([datafile], (parsed for _, parsed in islice(parsed_ranges, len(ranges))))
+                        for datafile, ranges in zip(all_files, file_ranges))
+    elif stages.get('parse_chunks') and db.chunk_size:
+        # stream files chunk by chunk
+        parsed_units = (([datafile], stages['parse_chunks'](datafile, db.chunk_size)) for datafile in all_files)
+    elif stages.get('parse_batch') and db.song_batch_size > 1:
+        # parse many small files into one batch
+        units = [all_files[i:i + db.song_batch_size] for i in range(0, len(all_files), db.song_batch_size)]
+        load_func = stages['load_batch']
+        parsed_units = ((unit, [parsed]) for unit, parsed
+                        in iter_parsed_files(units, cached(db, stages['parse_batch']), db.workers, db.queue_size))
+    else:
+        parsed_units = (([datafile], [parsed]) for datafile, parsed
+                        in iter_parsed_files(all_files, cached(db, stages['parse']), db.workers, db.queue_size))
+
+    # iterate over files and process, reporting progress every tenth of the files
+    files_pending, rows_pending = [], 0
+    progress_step = max(num_files // 10, 1)
+    for unit, batches in parsed_units:
+        for parsed in batches:
+            with metrics.stage('load'):
+                rows = load_func(db, *parsed)
+                metrics.add(rows_out=rows)
+            rows_pending += rows
+        files_pending.extend(unit)
+
+        with metrics.stage('load'):
+            if db.incremental:
+                for datafile in unit:
+                    db.cur.execute(manifest_upsert, file_stats[datafile])
+
+            if len(files_pending) >= db.commit_files or (db.commit_rows and rows_pending >= db.commit_rows):
+                write_checkpoint(db, filepath, files_pending)
+                db.conn.commit()
+                files_pending, rows_pending = [], 0
+
+        if (num_done + len(unit)) // progress_step > num_done // progress_step:
+            print('{}/{} files processed.'.format(num_done + len(unit), num_files))
+        num_done += len(unit)
+
+    # the pass is complete, clear its checkpoint together with the last batch
+    with metrics.stage('load'):
+        db.cur.execute(checkpoint_delete, (filepath,))
         db.conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
 
-def transform_song_data(cur, datafile):
+    if db.parse_cache:
+        with metrics.stage('cache'):
+            removed = db.parse_cache.evict()
+        if removed:
+            print('{} entries evicted from the parsed-file cache.'.format(removed))
+
+def cached(db, parse_func):
     """
-    Transforms and loads song data from a JSON file into the database.
+    Returns `parse_func` reading through the parsed-file cache when one is configured.
+
+    Args:
+        db (Database object): The database object holding the cache.
+        parse_func (function): Module-level parse function.
+
+    Returns:
+        function: A picklable function parsing one item, for `iter_parsed_files`.
+    """
+    if db.parse_cache:
+        return partial(parse_cached, db.parse_cache, parse_func)
+    return parse_func
+
+def select_changed_files(db, all_files):
+    """
+    Compares files against the `etl_manifest` table and keeps the ones that need loading.
+
+    A file whose size and modification time match its manifest entry is skipped without
+    being read. Otherwise its content hash decides: new or changed content is loaded, while
+    a file that was only touched gets its manifest entry refreshed.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        all_files (list): Absolute paths of the discovered files.
+
+    Returns:
+        tuple: (files, file_stats) where `files` lists the files to load and `file_stats` maps
+        each of them to its (path, size, mtime, content_hash) manifest record.
+    """
+    db.cur.execute(manifest_select)
+    manifest = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in db.cur.fetchall()}
+
+    files = []
+    file_stats = {}
+    for datafile in all_files:
+        path = os.path.relpath(datafile)
+        stat = os.stat(datafile)
+        entry = manifest.get(path)
+
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            continue
+
+        record = (path, stat.st_size, stat.st_mtime, hash_file(datafile))
+        if entry and entry[2] == record[3]:
+            db.cur.execute(manifest_upsert, record)
+            continue
+
+        files.append(datafile)
+        file_stats[datafile] = record
+
+    db.conn.commit()
+    return files, file_stats
+
+def read_checkpoint(db, filepath):
+    """
+    Reads the files committed for a data directory by an interrupted run.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        filepath (str): Path to the data directory the checkpoint belongs to.
+
+    Returns:
+        set: Paths of the committed files relative to `filepath`, empty when no run was interrupted.
+    """
+    db.cur.execute(checkpoint_select, (filepath,))
+    return {loaded_file for loaded_file, in db.cur.fetchall()}
+
+def write_checkpoint(db, filepath, datafiles):
+    """
+    Records `datafiles` as loaded files of `filepath` in the current transaction.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        filepath (str): Path to the data directory the checkpoint belongs to.
+        datafiles (list): Paths of the files loaded in the transaction.
+    """
+    db.cur.execute(checkpoint_insert, (filepath, [os.path.relpath(datafile, filepath) for datafile in datafiles]))
+
+def iter_parsed_files(all_files, parse_func, workers=1, queue_size=2):
+    """
+    Parses files with `parse_func` and yields the results in the order of `all_files`.
+
+    With more than one worker the files are parsed by a process pool. At most `queue_size`
+    files are parsed ahead of the loader, which bounds the memory held by finished batches.
+
+    Args:
+        all_files (list): Paths of the files to parse, or lists of paths for a batch parser.
+        parse_func (function): Module-level function parsing one item of `all_files`.
+        workers (int): Number of parser processes, 1 parses in the calling process.
+        queue_size (int): Maximum number of files parsed but not yet yielded.
+
+    Yields:
+        tuple: (datafile, parsed) for each file.
+    """
+    # the stage metrics of files parsed in worker processes are merged into this process' metrics
+    if workers <= 1:
+        for datafile in all_files:
+            yield datafile, parse_func(datafile)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        files = iter(all_files)
+        pending = deque()
+
+        for datafile in files:
+            pending.append((datafile, executor.submit(parse_in_worker, parse_func, datafile)))
+            if len(pending) >= queue_size:
+                break
+
+        while pending:
+            datafile, future = pending.popleft()
+            parsed, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file, executor.submit(parse_in_worker, parse_func, next_file)))
+
+            yield datafile, parsed
+
+def parse_in_worker(parse_func, datafile):
+    """
+    Runs `parse_func` in a worker process and returns the stage metrics it recorded with the result.
+
+    Args:
+        parse_func (function): Module-level function parsing one file.
+        datafile: Path, or list of paths, passed to `parse_func`.
+
+    Returns:
+        tuple: (parsed, metrics snapshot).
+    """
+    metrics.reset()
+    parsed = parse_func(datafile)
+    return parsed, metrics.snapshot()
+
+def parse_song_file(datafile):
+    """
+    Parses a song JSON file into song and artist records.
 
     Args:
-        cur (cursor object): Database cursor to execute queries.
         datafile (str): Path to the JSON file containing song data.
+
+    Returns:
+        tuple: (song_data, artist_data) lists for the song and artist tables.
     """
     # open song file
-    df = pd.read_json(datafile, lines=True)
+    with metrics.stage('parse'):
+        df = pd.read_json(datafile, lines=True)
+        metrics.add(rows_out=len(df), bytes_read=os.path.getsize(datafile))
 
-    # insert song record
-    song_data = list(df[['song_id', 'title', 'artist_id', 'year', 'duration']].values[0])
+    with metrics.stage('transform'):
+        # song record
+        song_data = list(df[['song_id', 'title', 'artist_id', 'year', 'duration']].values[0])
 
-    # insert artist record
-    artist_data = list(df[['artist_id', 'artist_name', 'artist_location',
-                       'artist_latitude', 'artist_longitude']].values[0])
+        # artist record
+        artist_data = list(df[['artist_id', 'artist_name', 'artist_location',
+                           'artist_latitude', 'artist_longitude']].values[0])
+        metrics.add(rows_in=len(df), rows_out=2)
 
-    # Load data into the database
-    load_song_data(cur, song_data, artist_data)
+    return song_data, artist_data
 
-def transform_log_data(cur, datafile):
+def parse_song_batch(datafiles):
     """
-    Transforms and loads log data from a JSON file into the database.
+    Parses many song JSON files into one columnar batch of songs and artists.
+
+    Each line is decoded with the `json` module, skipping the DataFrame built per file by
+    `parse_song_file`. Songs and artists appearing more than once in the batch are kept once.
+
+    Args:
+        datafiles (list): Paths to the JSON files containing song data.
+
+    Returns:
+        tuple: (song_df, artist_df) DataFrames for the song and artist tables.
+    """
+    columns = {key: [] for key in ('song_id', 'title', 'artist_id', 'year', 'duration', 'artist_name',
+                                   'artist_location', 'artist_latitude', 'artist_longitude')}
+    with metrics.stage('parse'):
+        for datafile in datafiles:
+            with open(datafile, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    for key, values in columns.items():
+                        values.append(record.get(key))
+            metrics.add(bytes_read=os.path.getsize(datafile))
+        metrics.add(rows_out=len(columns['song_id']))
+
+    with metrics.stage('transform'):
+        batch_df = pd.DataFrame(columns)
+        song_df = batch_df[['song_id', 'title', 'artist_id', 'year', 'duration']].drop_duplicates('song_id')
+        artist_df = batch_df[['artist_id', 'artist_name', 'artist_location',
+                              'artist_latitude', 'artist_longitude']].drop_duplicates('artist_id')
+        metrics.add(rows_in=len(batch_df), rows_out=len(song_df) + len(artist_df))
+
+    return song_df, artist_df
+
+def parse_log_file(datafile):
+    """
+    Parses a log JSON file into time, user and songplay frames.
 
     Args:
-        cur (cursor object): Database cursor to execute queries.
         datafile (str): Path to the JSON file containing log data.
+
+    Returns:
+        tuple: (time_df, user_df, log_df) DataFrames.
     """
     # open log file
-    log_df = pd.read_json(datafile, lines=True)
+    with metrics.stage('parse'):
+        log_df = pd.read_json(datafile, lines=True)
+        metrics.add(rows_out=len(log_df), bytes_read=os.path.getsize(datafile))
+
+    return transform_log_frame(log_df)
+
+def parse_log_chunks(datafile, chunk_size):
+    """
+    Streams a log JSON file in chunks of `chunk_size` lines, so memory use does not
+    grow with the size of the file.
+
+    Args:
+        datafile (str): Path to the JSON file containing log data.
+        chunk_size (int): Number of lines read per chunk.
+
+    Yields:
+        tuple: (time_df, user_df, log_df) DataFrames for each chunk.
+    """
+    with metrics.stage('parse'):
+        reader = pd.read_json(datafile, lines=True, chunksize=chunk_size)
+        metrics.add(bytes_read=os.path.getsize(datafile))
+
+    with reader:
+        while True:
+            with metrics.stage('parse'):
+                log_df = next(reader, None)
+                if log_df is not None:
+                    metrics.add(rows_out=len(log_df))
+
+            if log_df is None:
+                break
+            yield transform_log_frame(log_df)
+
+def line_ranges(datafile, range_size):
+    """
+    Splits a newline delimited JSON file into byte ranges of about `range_size` bytes, each
+    ending after a newline, by looking up the first newline past every split point in a
+    memory map of the file.
+
+    Args:
+        datafile (str): Path to the JSON file.
+        range_size (int): Target size of a range in bytes.
+
+    Returns:
+        list: (datafile, start, end) byte ranges covering the file in order. Ranges holding only
+        whitespace, such as blank lines at the end of the file, are left out.
+    """
+    size = os.path.getsize(datafile)
+    if not size:
+        return []
+
+    ranges = []
+    with open(datafile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            newline = mm.find(b'\n', min(start + range_size, size) - 1)
+            end = size if newline == -1 else newline + 1
+            # the search stops at the range's first non-whitespace byte, usually its first byte
+            if NON_WHITESPACE.search(mm, start, end):
+                ranges.append((datafile, start, end))
+            start = end
+    return ranges
 
-    # filter by NextSong section
-    log_df = log_df[log_df['page'] == 'NextSong']
+def parse_log_range(byte_range):
+    """
+    Parses the events in one byte range of a log JSON file into time, user and songplay
+    frames. The file is memory-mapped, so a worker only reads its own range.
+
+    Args:
+        byte_range (tuple): (datafile, start, end) as returned by `line_ranges`.
+
+    Returns:
+        tuple: (time_df, user_df, log_df) DataFrames.
+    """
+    datafile, start, end = byte_range
+    with metrics.stage('parse'):
+        with open(datafile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+        log_df = pd.read_json(BytesIO(data), lines=True)
+        metrics.add(rows_out=len(log_df), bytes_read=end - start)
+
+    return transform_log_frame(log_df)
+
+def songplay_ids(log_df):
+    """
+    Derives the songplay ids from the content of each event: a 63-bit hash of its start time,
+    user, session and position in the session. The same event always gets the same id, so
+    reruns stay idempotent, and files, chunks and workers need no shared sequence to avoid
+    collisions.
+
+    Args:
+        log_df (DataFrame): NextSong events.
+
+    Returns:
+        Series: Non-negative int64 ids aligned with `log_df`.
+    """
+    # fixed dtypes, the hash of a value depends on how read_json typed its column
+    key = pd.DataFrame({
+        'ts': log_df['ts'].astype('int64'),
+        'userId': pd.to_numeric(log_df['userId']).astype('int64'),
+        'sessionId': log_df['sessionId'].astype('int64'),
+        'itemInSession': log_df['itemInSession'].astype('int64')
+    })
+    hashes = pd.util.hash_pandas_object(key, index=False)
+    return (hashes & 0x7FFFFFFFFFFFFFFF).astype('int64')
+
+def transform_log_frame(log_df):
+    """
+    Transforms raw log events into time, user and songplay frames.
+
+    Args:
+        log_df (DataFrame): Log events as read from a log JSON file.
+
+    Returns:
+        tuple: (time_df, user_df, log_df) DataFrames.
+    """
+    with metrics.stage('transform'):
+        num_events = len(log_df)
+
+        # filter by NextSong section
+        log_df = log_df[log_df['page'] == 'NextSong']
+        log_df = log_df.assign(songplay_id=songplay_ids(log_df))
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(log_df['ts'])
+        # time data records, one per distinct start time
+        ts = log_df['ts'].drop_duplicates()
 
-    # time data records
-    time_data = [(tt.value, tt.hour, tt.day, tt.week, tt.month, tt.year, tt.weekday()) for tt in t]
-    time_df = pd.DataFrame(time_data, columns=('timestamp', 'hour', 'day', 'week', 'month', 'year', 'weekday'))
+        # convert epoch milliseconds to datetime
+        t = pd.to_datetime(ts, unit='ms').dt
 
-    # user table records
-    user_df = log_df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+        time_df = pd.DataFrame({
+            'timestamp': ts.to_numpy(),
+            'hour': t.hour.to_numpy(),
+            'day': t.day.to_numpy(),
+            'week': t.isocalendar().week.to_numpy(dtype='int64'),
+            'month': t.month.to_numpy(),
+            'year': t.year.to_numpy(),
+            'weekday': t.weekday.to_numpy()
+        })
+
+        # user table records
+        user_df = log_df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+
+        metrics.add(rows_in=num_events, rows_out=len(time_df) + len(user_df) + len(log_df))
+
+    return time_df, user_df, log_df
+
+def transform_song_data(db, datafile):
+    """
+    Transforms and loads song data from a JSON file into the database.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        datafile (str): Path to the JSON file containing song data.
+    """
+    song_data, artist_data = parse_song_file(datafile)
+
+    # Load data into the database
+    load_song_data(db, song_data, artist_data)
+
+def transform_log_data(db, datafile):
+    """
+    Transforms and loads log data from a JSON file into the database.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        datafile (str): Path to the JSON file containing log data.
+    """
+    time_df, user_df, log_df = parse_log_file(datafile)
 
     # Load time data, user data, and songplay data
-    load_log_data(cur,time_df, user_df, log_df)
+    load_log_data(db, time_df, user_df, log_df)
 
-def load_song_data(cur, song_data, artist_data):
+def copy_dataframe(cur, df, copy_query):
     """
-    Loads song and artist data into the respective tables.
+    Streams a DataFrame to the database through a COPY ... FROM STDIN statement. Cursors
+    of embedded sinks insert the DataFrame into the COPY target directly.
 
     Args:
         cur (cursor object): Database cursor to execute queries.
+        df (DataFrame): Rows to copy, with columns in the order expected by `copy_query`.
+        copy_query (str): COPY statement reading CSV from STDIN, with `\\N` marking NULL.
+    """
+    if hasattr(cur, 'copy_dataframe'):
+        cur.copy_dataframe(df, copy_query)
+        return
+
+    buffer = StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+    cur.copy_expert(copy_query, buffer)
+
+def load_song_data(db, song_data, artist_data):
+    """
+    Loads song and artist data into the respective tables.
+
+    Args:
+        db (Database object): The database object to use for database operations.
         song_data (list): Data for the song table.
         artist_data (list): Data for the artist table.
+
+    Returns:
+        int: Number of records sent to the database.
     """
     if song_data and artist_data:
-        cur.execute(song_table_insert, song_data)
-        cur.execute(artist_table_insert, artist_data)
+        metrics.add(rows_in=2)
+        db.execute(song_table_insert, song_data)
+        db.execute(artist_table_insert, artist_data)
+        return 2
+    return 0
 
-def load_log_data(cur, time_df, user_df, log_df):
+def load_song_batch(db, song_df, artist_df):
     """
-    Loads log data into the database. Inserts data into the time, user, and songplay tables.
+    Bulk loads a batch of songs and artists by copying them into the unlogged staging tables
+    and merging each with one set-based insert.
 
     Args:
-        cur (cursor object): Database cursor to execute queries.
+        db (Database object): The database object to use for database operations.
+        song_df (DataFrame): DataFrame containing song data.
+        artist_df (DataFrame): DataFrame containing artist data.
+
+    Returns:
+        int: Number of records sent to the database.
+    """
+    metrics.add(rows_in=len(song_df) + len(artist_df))
+
+    if not song_df.empty:
+        copy_dataframe(db.cur, song_df, song_staging_copy)
+        db.cur.execute(song_table_merge)
+
+    if not artist_df.empty:
+        copy_dataframe(db.cur, artist_df, artist_staging_copy)
+        db.cur.execute(artist_table_merge)
+
+    db.cur.execute(song_staging_truncate)
+
+    return len(song_df) + len(artist_df)
+
+def insert_log_data(db, time_df, user_df, log_df, song_lookup=None):
+    """
+    Inserts time, user and songplay data one row at a time, looking up the song and artist
+    of every songplay with its own query unless an in-memory lookup is given.
+
+    Args:
+        db (Database object): The database object to use for database operations.
         time_df (DataFrame): DataFrame containing time data.
         user_df (DataFrame): DataFrame containing user data.
         log_df (DataFrame): DataFrame containing log data used for songplays.
+        song_lookup (SongLookup): Optional in-memory song and artist index.
     """
     # insert time data records
     if not time_df.empty:
         for _, row in time_df.iterrows():
-            cur.execute(time_table_insert, list(row))
+            db.execute(time_table_insert, list(row))
     
     # insert user records
     if not user_df.empty:
         for _, row in user_df.iterrows():
-            cur.execute(user_table_insert, list(row))
+            db.execute(user_table_insert, list(row))
     
     # insert songplay records
     if not log_df.empty:
-        for index, row in log_df.iterrows():
-            # get songid and artistid from song and artist tables
-            cur.execute(song_select, (row.song, row.artist, row.length))
-            result = cur.fetchone()
-
-            if result:
-                songid, artistid = result
+        for _, row in log_df.iterrows():
+            # get songid and artistid from the lookup or the song and artist tables
+            if song_lookup:
+                songid, artistid = song_lookup.get(row.song, row.artist, row.length)
             else:
-                songid, artistid = None, None
+                db.execute(song_select, (row.song, row.artist, row.length))
+                result = db.cur.fetchone()
+
+                if result:
+                    songid, artistid = result
+                else:
+                    songid, artistid = None, None
             
             # insert songplay record
-            songplay_data = (index, row['ts'], row['userId'], row['level'], songid, artistid, row['sessionId'],row['location'], row['userAgent'])
-            cur.execute(songplay_table_insert, songplay_data)
+            songplay_data = (row['songplay_id'], row['ts'], row['userId'], row['level'], songid, artistid, row['sessionId'],row['location'], row['userAgent'])
+            db.execute(songplay_table_insert, songplay_data)
+
+def copy_log_data(cur, time_df, user_df, log_df, song_lookup=None):
+    """
+    Bulk loads a batch of log data. Each frame is copied into its unlogged staging table and
+    merged with one set-based statement per table; songplays resolve their song and artist
+    with a single join against the songs and artists tables, or from the in-memory lookup
+    when one is given.
+
+    Args:
+        cur (cursor object): Database cursor to execute queries.
+        time_df (DataFrame): DataFrame containing time data.
+        user_df (DataFrame): DataFrame containing user data.
+        log_df (DataFrame): DataFrame containing log data used for songplays.
+        song_lookup (SongLookup): Optional in-memory song and artist index.
+    """
+    if not time_df.empty:
+        copy_dataframe(cur, time_df, time_staging_copy)
+        cur.execute(time_table_merge)
+
+    # a single upsert cannot touch the same user twice, the user cache leaves one row per user
+    if not user_df.empty:
+        copy_dataframe(cur, user_df, user_staging_copy)
+        cur.execute(user_table_merge)
+
+    if not log_df.empty:
+        songplay_df = log_df[['songplay_id', 'ts', 'userId', 'level', 'song', 'artist', 'length',
+                              'sessionId', 'location', 'userAgent']]
+        if song_lookup:
+            resolved = [song_lookup.get(*key) for key in zip(log_df['song'], log_df['artist'], log_df['length'])]
+            songplay_df = songplay_df.assign(song_id=[songid for songid, _ in resolved],
+                                             artist_id=[artistid for _, artistid in resolved])
+            copy_dataframe(cur, songplay_df, songplay_staging_resolved_copy)
+            cur.execute(songplay_table_resolved_merge)
+        else:
+            copy_dataframe(cur, songplay_df, songplay_staging_copy)
+            cur.execute(songplay_table_merge)
+
+    cur.execute(staging_truncate)
+
+def create_songplay_partitions(db, ts):
+    """
+    Creates the monthly songplays partitions the given start times fall in, when songplays is
+    partitioned. Partitions are unlogged until a bootstrap load is finalized.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        ts (Series): Start times of the songplays to load, in milliseconds.
+    """
+    months = pd.to_datetime(ts, unit='ms').dt.to_period('M').unique()
+    for month in months:
+        if month in db.songplay_partitions:
+            continue
+        db.cur.execute(songplay_partition_create.format(
+            unlogged='UNLOGGED ' if db.bootstrap else '',
+            month=month.strftime('%Y_%m'),
+            start=month.start_time.value // 10**6,
+            end=(month + 1).start_time.value // 10**6))
+        db.songplay_partitions.add(month)
+
+def load_log_data(db, time_df, user_df, log_df):
+    """
+    Loads log data into the database. Inserts data into the time, user, and songplay tables.
+
+    With `load_mode = copy` the batch is bulk loaded through staging tables,
+    otherwise every row is inserted with its own statement.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+        time_df (DataFrame): DataFrame containing time data.
+        user_df (DataFrame): DataFrame containing user data.
+        log_df (DataFrame): DataFrame containing log data used for songplays.
+
+    Returns:
+        int: Number of records sent to the database.
+    """
+    metrics.add(rows_in=len(time_df) + len(user_df) + len(log_df))
+
+    # skip start times written by the previous batch, keeping only this batch's for the next
+    start_times = set(time_df['timestamp'].tolist())
+    if db.previous_start_times:
+        time_df = time_df[~time_df['timestamp'].isin(db.previous_start_times)]
+    db.previous_start_times = start_times
+
+    # only send new users and level changes
+    user_df = db.user_cache.filter(user_df)
+
+    if db.partitioned:
+        create_songplay_partitions(db, log_df['ts'])
+
+    if db.load_mode == 'copy':
+        copy_log_data(db.cur, time_df, user_df, log_df, db.song_lookup)
+    else:
+        insert_log_data(db, time_df, user_df, log_df, db.song_lookup)
+
+    return len(time_df) + len(user_df) + len(log_df)
+
+def refresh_aggregates(db):
+    """
+    Adds the songplays inserted since the last refresh, collected in songplays_delta by the
+    songplays_capture trigger, to the daily aggregate tables, then empties songplays_delta.
+    Runs in one transaction, so a failed refresh leaves the delta for the next run.
+
+    Args:
+        db (Database object): The database object to use for database operations.
+
+    Returns:
+        int: Number of songplays added to the aggregates.
+    """
+    db.cur.execute(songplay_delta_count)
+    new_songplays = db.cur.fetchone()[0]
+    if new_songplays:
+        for query in aggregate_refresh_queries:
+            db.cur.execute(query)
+        db.cur.execute(songplay_delta_truncate)
+    db.conn.commit()
+    metrics.add(rows_in=new_songplays)
+    return new_songplays
+
+# parse and load halves of each transform, so parsing can run in worker processes,
+# plus the chunked parser streaming large files, the range parser splitting them across
+# workers and the batch stages loading many files at once
+TRANSFORM_STAGES = {
+    transform_song_data: {'parse': parse_song_file, 'load': load_song_data,
+                          'parse_batch': parse_song_batch, 'load_batch': load_song_batch},
+    transform_log_data: {'parse': parse_log_file, 'load': load_log_data,
+                         'parse_chunks': parse_log_chunks, 'parse_range': parse_log_range},
+}
+
+def print_stage_summary():
+    """
+    Prints the wall time, rows and statements of every stage measured during the run.
+    """
+    print('{:<10}{:>10}{:>8}{:>12}{:>12}{:>14}{:>12}'.format(
+        'stage', 'seconds', 'calls', 'rows in', 'rows out', 'bytes read', 'statements'))
+    for name, record in metrics.stages.items():
+        print('{:<10}{:>10.3f}{:>8}{:>12}{:>12}{:>14}{:>12}'.format(
+            name, record.seconds, record.calls, record.rows_in, record.rows_out,
+            record.bytes_read, record.statements))
+
+def write_run_reports(config_data, db, error=None):
+    """
+    Writes the run report, the Prometheus textfile and the profile of the hottest stage,
+    for each of them that is configured.
+
+    Args:
+        config_data (dict): Configuration data containing the ETL settings.
+        db (Database object): The database object of the run, or None if it never connected.
+        error (str): The error that stopped the run, if any.
+    """
+    caches = {}
+    if db and db.song_lookup:
+        caches['song_lookup'] = db.song_lookup.stats()
+    if db:
+        caches['user_cache'] = db.user_cache.stats()
+
+    if config_data.get('run_report'):
+        metrics.write_json(config_data['run_report'], status='failed' if error else 'succeeded',
+                           error=error, caches=caches)
+        print('Run report written to {}'.format(config_data['run_report']))
+
+    if config_data.get('prometheus_textfile'):
+        metrics.write_prometheus(config_data['prometheus_textfile'], succeeded=error is None)
+
+    if config_data.get('profile_dir'):
+        stage = metrics.write_profile(config_data['profile_dir'])
+        if stage:
+            print('Profile of the {} stage written to {}'.format(stage, config_data['profile_dir']))
 
 def main():
     """
     - Main function that initializes the database, processes song and log data, and handles exceptions.
 
-    - Runs ETL pipelines
+    - Runs ETL pipelines, loading every song and artist before any songplay
+
+    - Refreshes the daily aggregate tables with the songplays added by the run
+
+    - On tables created with `create_tables.py --bootstrap`, builds the lookup indexes once the
+      songs are loaded, and finalizes the tables once the songplays are loaded
     """
     db = None
+    config_data = {}
+    error = None
     try:
         config_data = read_config()
-        db = Database(config_data)
+        metrics.reset(profile=bool(config_data['profile_dir']))
+        db = open_database(config_data)
         extract_data_from_file(db, filepath='data/song_data', func=transform_song_data)
+        if db.bootstrap:
+            with metrics.stage('finalize'):
+                create_indexes(db.cur, db.conn, lookup_index_queries)
+        db.song_lookup = build_song_lookup(db, config_data)
         extract_data_from_file(db, filepath='data/log_data',func=transform_log_data)
+        with metrics.stage('aggregate'):
+            print("Aggregates refreshed with {} new songplays.".format(refresh_aggregates(db)))
+        if db.bootstrap:
+            print("Finalizing bootstrap tables: switching to logged, adding indexes and foreign keys...")
+            with metrics.stage('finalize'):
+                finalize_tables(db.cur, db.conn)
+        if db.song_lookup:
+            print(db.song_lookup.report())
+        print(db.user_cache.report())
         print("ETL process completed successfully.")
 
     except Exception as e:
+        error = f"{type(e).__name__}: {e}"
         print(f"An error occurred during the ETL process: {e}")
+        traceback.print_exc()
     
     finally:
         if db:
             db.close()
             print("Database connection closed.")
+        print_stage_summary()
+        write_run_reports(config_data, db, error)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+import os
+import json
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+FIRST_NAMES = ['Walter', 'Kaylee', 'Lily', 'Jacob', 'Chloe', 'Mohammad', 'Tegan', 'Aleena', 'Jayden',
+               'Ava', 'Sara', 'Cienna', 'Rylan', 'Layla', 'Matthew', 'Kate', 'Jordyn', 'Stefany',
+               'Adelyn', 'Ryan', 'Theodore', 'Emily', 'Noah', 'Anabelle', 'Connar', 'Samuel']
+LAST_NAMES = ['Frye', 'Summers', 'Koch', 'Klein', 'Cuevas', 'Rodriguez', 'Levine', 'Kirby', 'Graves',
+              'Robinson', 'Johnson', 'Freeman', 'George', 'Griffin', 'Jones', 'Harrell', 'Powell',
+              'White', 'Jordan', 'Smith', 'Harris', 'Benson', 'Daniel', 'Moreno', 'Hess', 'Lee']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA',
+             'Atlanta-Sandy Springs-Roswell, GA', 'Lansing-East Lansing, MI',
+             'Portland-South Portland, ME', 'Tampa-St. Petersburg-Clearwater, FL',
+             'Houston-The Woodlands-Sugar Land, TX', 'Seattle-Tacoma-Bellevue, WA']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 Safari/537.36"',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+ARTIST_LOCATIONS = ['', '', '', 'California - LA', 'New York, NY', 'Chicago, IL', 'Panama', 'Fort Worth, TX',
+                    'London, England', 'Hamilton, Ohio']
+WORDS = ['Love', 'Night', 'Midnight', 'Star', 'Soul', 'Fire', 'Street', 'Dream', 'Heart', 'Blue', 'City',
+         'Girl', 'Native', 'Ballad', 'Sleeping', 'Beauty', 'Shade', 'Pale', 'Music', 'Living', 'Hell',
+         'Intro', 'Prognosis', 'Summer', 'Rain', 'Gold', 'Road', 'Home', 'Time', 'Light']
+
+# pages visited between songs, with their request method and status, roughly as frequent as in the samples
+OTHER_PAGES = [('Home', 'GET', 200, 40), ('Settings', 'GET', 200, 3), ('Help', 'GET', 200, 3),
+               ('About', 'GET', 200, 2), ('Downgrade', 'GET', 200, 3), ('Upgrade', 'GET', 200, 1),
+               ('Save Settings', 'PUT', 307, 1), ('Error', 'GET', 404, 1)]
+
+def make_id(rng, prefix):
+    """
+    Builds an 18 character identifier shaped like the sample song, artist and track ids.
+
+    Args:
+        rng (Random): Random number generator.
+        prefix (str): Two letter prefix such as 'SO', 'AR' or 'TR'.
+
+    Returns:
+        str: The identifier.
+    """
+    return prefix + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(16))
+
+def make_title(rng):
+    """
+    Builds a song title or artist name from a few random words.
+    """
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+def generate_songs(rng, num_songs, num_artists):
+    """
+    Generates song records in the format of the files under data/song_data.
+
+    Args:
+        rng (Random): Random number generator.
+        num_songs (int): Number of songs to generate.
+        num_artists (int): Number of distinct artists the songs are spread over.
+
+    Returns:
+        list: Song records, one dict per song file.
+    """
+    artists = []
+    for _ in range(num_artists):
+        located = rng.random() < 0.4
+        artists.append({
+            'artist_id': make_id(rng, 'AR'),
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+            'artist_longitude': round(rng.uniform(-120, 120), 5) if located else None,
+            'artist_location': rng.choice(ARTIST_LOCATIONS),
+            'artist_name': make_title(rng)
+        })
+
+    songs = []
+    for _ in range(num_songs):
+        artist = rng.choice(artists)
+        song = {'num_songs': 1}
+        song.update(artist)
+        song.update({
+            'song_id': make_id(rng, 'SO'),
+            'title': make_title(rng),
+            'duration': round(rng.lognormvariate(5.4, 0.35), 5),
+            'year': rng.choice([0, 0, rng.randint(1960, 2010)])
+        })
+        songs.append(song)
+
+    return songs
+
+def write_song_files(output_dir, rng, songs):
+    """
+    Writes one JSON file per song, nested by track id like data/song_data/A/A/A/TRAAAAW128F429D538.json.
+
+    Args:
+        output_dir (str): Root directory of the generated data.
+        rng (Random): Random number generator.
+        songs (list): Song records from `generate_songs`.
+    """
+    for song in songs:
+        track_id = make_id(rng, 'TR')
+        song_dir = os.path.join(output_dir, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + '.json'), 'w') as f:
+            f.write(json.dumps(song))
+
+def generate_users(rng, num_users, start):
+    """
+    Generates the users whose activity appears in the logs.
+
+    Args:
+        rng (Random): Random number generator.
+        num_users (int): Number of users.
+        start (datetime): First day of generated activity, registrations happen before it.
+
+    Returns:
+        list: User dicts with their current level.
+    """
+    start_ms = int(start.timestamp() * 1000)
+    users = []
+    for user_id in range(1, num_users + 1):
+        users.append({
+            'userId': str(user_id),
+            'firstName': rng.choice(FIRST_NAMES),
+            'lastName': rng.choice(LAST_NAMES),
+            'gender': rng.choice('MF'),
+            'level': 'paid' if rng.random() < 0.3 else 'free',
+            'location': rng.choice(LOCATIONS),
+            'userAgent': rng.choice(USER_AGENTS),
+            'registration': float(start_ms - rng.randint(1, 90) * 86400000 + 796),
+            # some users listen much more than others
+            'activity': rng.paretovariate(1.5)
+        })
+    return users
+
+def make_event(user, session_id, item, ts, page='NextSong', method='PUT', status=200, song=None):
+    """
+    Builds one log event with the same keys, in the same order, as the sample log files.
+    """
+    return {
+        'artist': song['artist_name'] if song else None,
+        'auth': 'Logged In',
+        'firstName': user['firstName'],
+        'gender': user['gender'],
+        'itemInSession': item,
+        'lastName': user['lastName'],
+        'length': song['duration'] if song else None,
+        'level': user['level'],
+        'location': user['location'],
+        'method': method,
+        'page': page,
+        'registration': user['registration'],
+        'sessionId': session_id,
+        'song': song['title'] if song else None,
+        'status': status,
+        'ts': ts,
+        'userAgent': user['userAgent'],
+        'userId': user['userId']
+    }
+
+def make_logged_out_event(user, session_id, item, ts):
+    """
+    Builds a Home page event for a visitor who is not logged in.
+    """
+    return {'artist': None, 'auth': 'Logged Out', 'firstName': None, 'gender': None, 'itemInSession': item,
+            'lastName': None, 'length': None, 'level': user['level'], 'location': None, 'method': 'GET',
+            'page': 'Home', 'registration': None, 'sessionId': session_id, 'song': None, 'status': 200,
+            'ts': ts, 'userAgent': None, 'userId': ''}
+
+def generate_day(rng, day, users, user_weights, songs, song_weights, sessions, match_rate, first_session_id):
+    """
+    Generates the events of one day.
+
+    Sessions pick users by activity; every session is a run of song plays with other pages mixed
+    in. Played songs follow a long-tailed popularity, and only `match_rate` of the plays refer to
+    a song in the catalog, the rest are songs the song data does not know.
+
+    Args:
+        rng (Random): Random number generator.
+        day (datetime): Day to generate, at midnight UTC.
+        users (list): Users from `generate_users`.
+        user_weights (list): Cumulative activity weights of `users`.
+        songs (list): Song catalog from `generate_songs`.
+        song_weights (list): Cumulative popularity weights of `songs`.
+        sessions (int): Number of sessions in the day.
+        match_rate (float): Share of song plays that match a song in the catalog.
+        first_session_id (int): Session id of the day's first session.
+
+    Returns:
+        list: The day's events sorted by timestamp.
+    """
+    day_ms = int(day.timestamp() * 1000)
+    page_weights = [weight for *_, weight in OTHER_PAGES]
+    events = []
+
+    for session_id in range(first_session_id, first_session_id + sessions):
+        user = rng.choices(users, cum_weights=user_weights)[0]
+        ts = day_ms + rng.randint(0, 86399) * 1000 + 796
+        item = 0
+
+        if rng.random() < 0.05:
+            events.append(make_logged_out_event(user, session_id, item, ts))
+            events.append(make_event(user, session_id, item + 1, ts, page='Login', status=307))
+            item += 2
+
+        for _ in range(max(1, int(rng.expovariate(1 / 8)))):
+            if rng.random() < 0.15:
+                page, method, status, _ = rng.choices(OTHER_PAGES, weights=page_weights)[0]
+                events.append(make_event(user, session_id, item, ts, page, method, status))
+                item += 1
+
+            # level changes show up as upgrade/downgrade submissions
+            if rng.random() < 0.003:
+                page = 'Submit Downgrade' if user['level'] == 'paid' else 'Submit Upgrade'
+                events.append(make_event(user, session_id, item, ts, page, 'PUT', 307))
+                user['level'] = 'free' if user['level'] == 'paid' else 'paid'
+                item += 1
+
+            if rng.random() < match_rate:
+                song = rng.choices(songs, cum_weights=song_weights)[0]
+            else:
+                song = {'artist_name': make_title(rng), 'title': make_title(rng),
+                        'duration': round(rng.lognormvariate(5.4, 0.35), 5)}
+            events.append(make_event(user, session_id, item, ts, song=song))
+            ts += int(song['duration'] * 1000)
+            item += 1
+
+        if rng.random() < 0.1:
+            events.append(make_event(user, session_id, item, ts, page='Logout', status=307))
+
+    # sessions running past midnight still belong to the day they started on
+    events.sort(key=lambda event: event['ts'])
+    return events
+
+def write_log_file(output_dir, day, events):
+    """
+    Writes a day of events as NDJSON, like data/log_data/2018/11/2018-11-01-events.json.
+
+    Args:
+        output_dir (str): Root directory of the generated data.
+        day (datetime): Day the events belong to.
+        events (list): Events from `generate_day`.
+    """
+    log_dir = os.path.join(output_dir, 'log_data', day.strftime('%Y'), day.strftime('%m'))
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, day.strftime('%Y-%m-%d') + '-events.json'), 'w') as f:
+        f.write('\n'.join(json.dumps(event, separators=(',', ':')) for event in events))
+
+def cumulative(weights):
+    """
+    Returns the running totals of `weights`, for repeated `Random.choices` calls.
+    """
+    total = 0
+    totals = []
+    for weight in weights:
+        total += weight
+        totals.append(total)
+    return totals
+
+def main():
+    """
+    - Parses the command line options.
+
+    - Generates the song catalog and writes one file per song.
+
+    - Generates users and writes one log file per day of activity.
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic Sparkify song and log data.')
+    parser.add_argument('--output-dir', default='synthetic_data', help='directory to write song_data/ and log_data/ to')
+    parser.add_argument('--songs', type=int, default=10000, help='number of song files')
+    parser.add_argument('--artists', type=int, default=0, help='number of artists (default: songs / 3)')
+    parser.add_argument('--users', type=int, default=1000, help='number of users')
+    parser.add_argument('--days', type=int, default=30, help='number of daily event files')
+    parser.add_argument('--sessions-per-day', type=int, default=500, help='number of sessions in each day')
+    parser.add_argument('--match-rate', type=float, default=0.5, help='share of song plays found in the song data')
+    parser.add_argument('--start-date', default='2018-11-01', help='first day of events, YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, the same seed writes the same data')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime.strptime(args.start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+    songs = generate_songs(rng, args.songs, args.artists or max(1, args.songs // 3))
+    write_song_files(args.output_dir, rng, songs)
+    print('{} song files written to {}'.format(len(songs), os.path.join(args.output_dir, 'song_data')))
+
+    users = generate_users(rng, args.users, start)
+    user_weights = cumulative(user['activity'] for user in users)
+    song_weights = cumulative(1 / rank ** 1.1 for rank in range(1, len(songs) + 1))
+
+    num_events = 0
+    for offset in range(args.days):
+        day = start + timedelta(days=offset)
+        events = generate_day(rng, day, users, user_weights, songs, song_weights, args.sessions_per_day,
+                              args.match_rate, offset * args.sessions_per_day + 1)
+        write_log_file(args.output_dir, day, events)
+        num_events += len(events)
+    print('{} events in {} log files written to {}'.format(num_events, args.days,
+                                                          os.path.join(args.output_dir, 'log_data')))
+
+if __name__ == "__main__":
+    main()
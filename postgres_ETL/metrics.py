@@ -0,0 +1,297 @@
+import os
+import io
+import re
+import json
+import time
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+import psycopg2.extensions
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is then reported as 0
+    resource = None
+
+VM_HWM = re.compile(r'^VmHWM:\s+(\d+) kB', re.MULTILINE)
+
+def peak_rss_kb():
+    """
+    Returns the resident set size high-water mark of the process in kilobytes, since it was
+    last reset with `reset_peak_rss`. Without /proc this is the process' all-time peak.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            return int(VM_HWM.search(f.read()).group(1))
+    except (OSError, AttributeError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+def reset_peak_rss():
+    """
+    Resets the high-water mark read by `peak_rss_kb` to the current resident set size.
+
+    Returns:
+        bool: Whether the kernel supports resetting it (Linux /proc/self/clear_refs).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+STAGE_FIELDS = ('seconds', 'calls', 'rows_in', 'rows_out', 'bytes_read', 'statements',
+                'peak_memory_kb', 'traced_peak_kb')
+
+class StageMetrics:
+    """
+    Counters of one ETL stage, accumulated over every time the stage runs.
+    """
+    def __init__(self):
+        """
+        Initializes every counter to zero.
+        """
+        for field in STAGE_FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        """
+        Returns the counters as a dictionary.
+        """
+        return {field: round(getattr(self, field), 6) for field in STAGE_FIELDS}
+
+class RunMetrics:
+    """
+    Collects wall time, row and byte counts, statement counts and peak memory per ETL stage
+    (discover, parse, transform, load), and writes them as a JSON run report or a Prometheus
+    textfile. With profiling enabled each stage also gets a cProfile profiler and tracemalloc
+    peaks, and the hottest stage's profile and allocations can be written out.
+    """
+    def __init__(self):
+        """
+        Initializes an empty registry with profiling disabled.
+        """
+        self.stages = {}
+        self.current = None
+        self.profile = False
+        self.profilers = {}
+        self.snapshots = {}
+        # peak memory of the enclosing stage that the high-water mark no longer shows, after
+        # being reset for a nested stage
+        self.outer_peak_kb = 0
+        self.started_at = time.time()
+
+    def reset(self, profile=False):
+        """
+        Clears every stage and starts a new run.
+
+        Args:
+            profile (bool): Whether to profile stages with cProfile and tracemalloc.
+        """
+        self.__init__()
+        self.profile = profile
+        if profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the enclosed block as one run of stage `name`.
+
+        Args:
+            name (str): Stage name.
+
+        Yields:
+            StageMetrics: The stage's counters, for the block to add rows and bytes to.
+        """
+        record = self.stages.setdefault(name, StageMetrics())
+        previous, self.current = self.current, name
+
+        profiler = None
+        if self.profile:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+            tracemalloc.reset_peak()
+            profiler.enable()
+
+        # the high-water mark is reset so that it covers this stage only, the enclosing stage
+        # keeps its own peak so far in `outer_peak_kb`
+        enclosing_peak_kb = max(peak_rss_kb(), self.outer_peak_kb)
+        self.outer_peak_kb = 0
+        reset_peak_rss()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds += time.perf_counter() - start
+            record.calls += 1
+            self.current = previous
+
+            if profiler:
+                profiler.disable()
+                traced_peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+                # keep the allocations of the stage's most memory hungry run
+                if traced_peak_kb > record.traced_peak_kb:
+                    record.traced_peak_kb = traced_peak_kb
+                    self.snapshots[name] = tracemalloc.take_snapshot()
+
+            stage_peak_kb = max(peak_rss_kb(), self.outer_peak_kb)
+            record.peak_memory_kb = max(record.peak_memory_kb, stage_peak_kb)
+            self.outer_peak_kb = max(enclosing_peak_kb, stage_peak_kb)
+
+    def add(self, **counters):
+        """
+        Adds to the counters of the current stage, or of `other` outside any stage.
+
+        Args:
+            **counters: Amounts to add, by field name, e.g. `rows_out=10`.
+        """
+        record = self.stages.setdefault(self.current or 'other', StageMetrics())
+        for field, value in counters.items():
+            setattr(record, field, getattr(record, field) + value)
+
+    def snapshot(self):
+        """
+        Returns the counters of every stage, e.g. to send them back from a worker process.
+        """
+        return {name: record.as_dict() for name, record in self.stages.items()}
+
+    def merge(self, snapshot):
+        """
+        Adds counters returned by `snapshot` in another process. Peak memory is that process'
+        own peak, so the highest value is kept.
+
+        Args:
+            snapshot (dict): Counters per stage.
+        """
+        for name, counters in snapshot.items():
+            record = self.stages.setdefault(name, StageMetrics())
+            for field, value in counters.items():
+                if field in ('peak_memory_kb', 'traced_peak_kb'):
+                    setattr(record, field, max(getattr(record, field), value))
+                else:
+                    setattr(record, field, getattr(record, field) + value)
+
+    def hottest_stage(self):
+        """
+        Returns the name of the stage with the most wall time, or None before any stage ran.
+        """
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda name: self.stages[name].seconds)
+
+    def report(self, **extra):
+        """
+        Builds the run report.
+
+        Args:
+            **extra: Additional top-level entries, such as the run status.
+
+        Returns:
+            dict: The run report.
+        """
+        report = {
+            'started_at': self.started_at,
+            'seconds': round(time.time() - self.started_at, 3),
+            'hottest_stage': self.hottest_stage(),
+            'stages': self.snapshot()
+        }
+        report.update(extra)
+        return report
+
+    def write_json(self, path, **extra):
+        """
+        Writes the run report to `path` as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(**extra), f, indent=2, default=str)
+
+    def write_prometheus(self, path, succeeded=True):
+        """
+        Writes the stage counters in the Prometheus textfile format. The file is written under a
+        temporary name and renamed, so the node exporter never reads a partial file.
+
+        Args:
+            path (str): Path of the `.prom` file.
+            succeeded (bool): Whether the run completed.
+        """
+        lines = []
+        for field in STAGE_FIELDS:
+            metric = 'sparkify_etl_stage_{}'.format(field)
+            lines.append('# TYPE {} gauge'.format(metric))
+            for name, record in self.stages.items():
+                lines.append('{}{{stage="{}"}} {}'.format(metric, name, getattr(record, field)))
+
+        lines.append('# TYPE sparkify_etl_run_success gauge')
+        lines.append('sparkify_etl_run_success {}'.format(int(succeeded)))
+        lines.append('# TYPE sparkify_etl_run_started_timestamp_seconds gauge')
+        lines.append('sparkify_etl_run_started_timestamp_seconds {}'.format(self.started_at))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def write_profile(self, directory):
+        """
+        Writes the cProfile statistics and the top tracemalloc allocations of the hottest stage
+        profiled in this process. Stages run in worker processes are not profiled.
+
+        Args:
+            directory (str): Directory to write `profile_<stage>.pstats` and `tracemalloc_<stage>.txt` to.
+
+        Returns:
+            str: Name of the profiled stage, or None when nothing was profiled.
+        """
+        if not self.profilers:
+            return None
+        name = max(self.profilers, key=lambda stage: self.stages[stage].seconds)
+
+        os.makedirs(directory, exist_ok=True)
+        self.profilers[name].dump_stats(os.path.join(directory, 'profile_{}.pstats'.format(name)))
+
+        summary = io.StringIO()
+        pstats.Stats(self.profilers[name], stream=summary).sort_stats('cumulative').print_stats(25)
+        if name in self.snapshots:
+            summary.write('\nTop allocations at the stage\'s memory peak:\n')
+            for stat in self.snapshots[name].statistics('lineno')[:25]:
+                summary.write('{}\n'.format(stat))
+        with open(os.path.join(directory, 'tracemalloc_{}.txt'.format(name)), 'w') as f:
+            f.write(summary.getvalue())
+
+        return name
+
+# registry of the current process, worker processes send theirs back with `snapshot`
+metrics = RunMetrics()
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor counting every statement and COPY it sends to the server in `metrics`.
+    """
+    def execute(self, query, params=None):
+        metrics.add(statements=1)
+        return super().execute(query, params)
+
+    def executemany(self, query, params_seq):
+        params_seq = list(params_seq)
+        metrics.add(statements=len(params_seq))
+        return super().executemany(query, params_seq)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.add(statements=1)
+        return super().copy_expert(sql, file, size)
+
+class CountingConnection(psycopg2.extensions.connection):
+    """
+    Connection handing out counting cursors and counting its commits as statements.
+    """
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        metrics.add(statements=1)
+        return super().commit()
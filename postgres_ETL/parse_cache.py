@@ -0,0 +1,189 @@
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import tempfile
+import pandas as pd
+from metrics import metrics
+
+def hash_file(datafile, block_size=1 << 20):
+    """
+    Computes the SHA-256 digest of a file's content.
+
+    Args:
+        datafile (str): Path to the file.
+        block_size (int): Number of bytes read at a time.
+
+    Returns:
+        str: Hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(datafile, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_source(item):
+    """
+    Computes the SHA-256 digest of the data a parse function reads.
+
+    Args:
+        item: A file path, a list of file paths, or a (datafile, start, end) byte range.
+
+    Returns:
+        str: Hex digest of the content.
+    """
+    if isinstance(item, list):
+        return hashlib.sha256(''.join(hash_file(datafile) for datafile in item).encode()).hexdigest()
+
+    if isinstance(item, tuple):
+        datafile, start, end = item
+        with open(datafile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm[start:end]).hexdigest()
+
+    return hash_file(item)
+
+class ParseCache:
+    """
+    On-disk cache of parsed and transformed batches, keyed by the content of their source
+    files, the parse function and the transform version. Every entry is a directory holding
+    one Feather (Arrow IPC) file per part of the parsed tuple. When the cache grows past
+    `max_bytes`, the least recently used entries are removed.
+    """
+    def __init__(self, directory, max_bytes, version):
+        """
+        Initializes the cache, creating its directory.
+
+        Args:
+            directory (str): Directory holding the cache entries.
+            max_bytes (int): Size the cache is trimmed to by `evict`.
+            version (str): Transform version, changing it invalidates every entry.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, parse_func, item):
+        """
+        Returns the cache key of parsing `item` with `parse_func`.
+        """
+        key = '{}:{}:{}'.format(self.version, parse_func.__name__, hash_source(item))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Reads a cache entry.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            tuple: The parsed parts, or None when the entry does not exist.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, 'parts.json')) as f:
+                kinds = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        parts = []
+        for i, kind in enumerate(kinds):
+            part_path = os.path.join(path, '{}.feather'.format(i))
+            df = pd.read_feather(part_path)
+            metrics.add(bytes_read=os.path.getsize(part_path))
+            # records are stored as one-row frames
+            parts.append(df.values[0].tolist() if kind == 'record' else df)
+
+        # the modification time orders entries for eviction
+        os.utime(path)
+        return tuple(parts)
+
+    def put(self, key, parsed):
+        """
+        Writes a cache entry. The entry is written to a temporary directory and renamed, so
+        readers never see a partial entry.
+
+        Args:
+            key (str): Cache key.
+            parsed (tuple): DataFrames, or lists of column values for single records.
+        """
+        kinds = []
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            for i, part in enumerate(parsed):
+                if isinstance(part, pd.DataFrame):
+                    kinds.append('frame')
+                    df = part.reset_index(drop=True)
+                else:
+                    kinds.append('record')
+                    df = pd.DataFrame([list(part)], columns=[str(c) for c in range(len(part))])
+                df.to_feather(os.path.join(tmp_path, '{}.feather'.format(i)))
+
+            with open(os.path.join(tmp_path, 'parts.json'), 'w') as f:
+                json.dump(kinds, f)
+            os.replace(tmp_path, os.path.join(self.directory, key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def entries(self):
+        """
+        Returns the entries of the cache as (modification time, size in bytes, path) tuples.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                continue
+            files = [os.path.join(path, f) for f in os.listdir(path)]
+            entries.append((os.path.getmtime(path), sum(os.path.getsize(f) for f in files), path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in `max_bytes`.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+def parse_cached(cache, parse_func, item):
+    """
+    Parses `item` with `parse_func`, reading the result from `cache` when the source data,
+    the parse function and the transform version are unchanged, and storing it otherwise.
+    Runs in worker processes like `parse_func` itself.
+
+    Args:
+        cache (ParseCache): The parsed-file cache.
+        parse_func (function): Module-level function parsing one item.
+        item: A file path, a list of file paths, or a (datafile, start, end) byte range.
+
+    Returns:
+        tuple: The parsed parts, as returned by `parse_func`.
+    """
+    with metrics.stage('cache'):
+        key = cache.key(parse_func, item)
+        parsed = cache.get(key)
+        # rows in counts lookups, rows out counts hits
+        metrics.add(rows_in=1, rows_out=int(parsed is not None))
+        if parsed is not None:
+            return parsed
+
+    parsed = parse_func(item)
+
+    with metrics.stage('cache'):
+        cache.put(key, parsed)
+    return parsed
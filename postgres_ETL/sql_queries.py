@@ -5,22 +5,58 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+time_staging_drop = "DROP TABLE IF EXISTS time_staging;"
+user_staging_drop = "DROP TABLE IF EXISTS users_staging;"
+songplay_staging_drop = "DROP TABLE IF EXISTS songplays_staging;"
+song_staging_drop = "DROP TABLE IF EXISTS songs_staging;"
+artist_staging_drop = "DROP TABLE IF EXISTS artists_staging;"
+checkpoint_table_drop = "DROP TABLE IF EXISTS etl_checkpoint;"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest;"
+songplay_delta_drop = "DROP TABLE IF EXISTS songplays_delta;"
+songplay_capture_drop = "DROP FUNCTION IF EXISTS songplays_capture() CASCADE;"
+daily_active_users_drop = "DROP TABLE IF EXISTS daily_active_users;"
+daily_user_plays_drop = "DROP TABLE IF EXISTS daily_user_plays;"
+daily_level_plays_drop = "DROP TABLE IF EXISTS daily_level_plays;"
+daily_song_plays_drop = "DROP TABLE IF EXISTS daily_song_plays;"
+daily_artist_plays_drop = "DROP TABLE IF EXISTS daily_artist_plays;"
 
 # CREATE TABLES
 
 songplay_table_create = ("""
 CREATE TABLE songplays
-(songplay_id int PRIMARY KEY, 
- start_time bigint REFERENCES time(start_time) ON DELETE RESTRICT, 
- user_id int REFERENCES users(user_id) ON DELETE RESTRICT, 
+(songplay_id bigint PRIMARY KEY, 
+ start_time bigint, 
+ user_id int, 
  level varchar, 
- song_id varchar REFERENCES songs(song_id) ON DELETE RESTRICT, 
- artist_id varchar REFERENCES artists(artist_id) ON DELETE RESTRICT, 
+ song_id varchar, 
+ artist_id varchar, 
  session_id int, 
  location varchar, 
  user_agent varchar);
 """)
 
+# songplays range partitioned by month of start_time, partitions are created by etl.py;
+# the partition key has to be part of the primary key
+songplay_partitioned_table_create = ("""
+CREATE TABLE songplays
+(songplay_id bigint, 
+ start_time bigint NOT NULL, 
+ user_id int, 
+ level varchar, 
+ song_id varchar, 
+ artist_id varchar, 
+ session_id int, 
+ location varchar, 
+ user_agent varchar,
+ PRIMARY KEY (songplay_id, start_time))
+PARTITION BY RANGE (start_time);
+""")
+
+songplay_partition_create = ("""
+CREATE {unlogged}TABLE IF NOT EXISTS songplays_{month} PARTITION OF songplays
+FOR VALUES FROM ({start}) TO ({end});
+""")
+
 user_table_create = ("""
 CREATE TABLE users
 (user_id int PRIMARY KEY, 
@@ -59,14 +95,171 @@ CREATE TABLE time
  weekday int);
 """)
 
+# STAGING TABLES
+
+time_staging_create = ("""
+CREATE UNLOGGED TABLE time_staging
+(LIKE time);
+""")
+
+user_staging_create = ("""
+CREATE UNLOGGED TABLE users_staging
+(LIKE users);
+""")
+
+songplay_staging_create = ("""
+CREATE UNLOGGED TABLE songplays_staging
+(songplay_id bigint, 
+ start_time bigint, 
+ user_id int, 
+ level varchar, 
+ song varchar, 
+ artist varchar, 
+ length float, 
+ song_id varchar, 
+ artist_id varchar, 
+ session_id int, 
+ location varchar, 
+ user_agent varchar);
+""")
+
+song_staging_create = ("""
+CREATE UNLOGGED TABLE songs_staging
+(LIKE songs);
+""")
+
+artist_staging_create = ("""
+CREATE UNLOGGED TABLE artists_staging
+(LIKE artists);
+""")
+
+# ETL BOOKKEEPING
+
+# files committed by the current pass of each data directory, cleared when the pass completes
+checkpoint_table_create = ("""
+CREATE TABLE etl_checkpoint
+(data_path varchar NOT NULL, 
+ loaded_file varchar NOT NULL, 
+ committed_at timestamp NOT NULL DEFAULT now(), 
+ PRIMARY KEY (data_path, loaded_file));
+""")
+
+manifest_table_create = ("""
+CREATE TABLE etl_manifest
+(path varchar PRIMARY KEY, 
+ size bigint NOT NULL, 
+ mtime float NOT NULL, 
+ content_hash varchar NOT NULL, 
+ loaded_at timestamp NOT NULL DEFAULT now());
+""")
+
+# AGGREGATE TABLES
+
+# songplays inserted since the last aggregate refresh, filled by the songplays_capture trigger
+# and emptied by the refresh in the same transaction
+songplay_delta_create = ("""
+CREATE TABLE songplays_delta (LIKE songplays);
+""")
+
+# one statement level trigger per INSERT, copying the rows actually inserted (not the conflicts)
+songplay_capture_create = ("""
+CREATE FUNCTION songplays_capture() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO songplays_delta SELECT * FROM new_songplays;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER songplays_capture AFTER INSERT ON songplays
+REFERENCING NEW TABLE AS new_songplays
+FOR EACH STATEMENT EXECUTE FUNCTION songplays_capture();
+""")
+
+daily_active_users_create = ("""
+CREATE TABLE daily_active_users
+(day date PRIMARY KEY, 
+ active_users int NOT NULL, 
+ plays bigint NOT NULL);
+""")
+
+# distinct users per day, keeps daily_active_users additive
+daily_user_plays_create = ("""
+CREATE TABLE daily_user_plays
+(day date, 
+ user_id int, 
+ plays bigint NOT NULL, 
+ PRIMARY KEY (day, user_id));
+""")
+
+daily_level_plays_create = ("""
+CREATE TABLE daily_level_plays
+(day date, 
+ level varchar, 
+ plays bigint NOT NULL, 
+ PRIMARY KEY (day, level));
+""")
+
+daily_song_plays_create = ("""
+CREATE TABLE daily_song_plays
+(day date, 
+ song_id varchar, 
+ plays bigint NOT NULL, 
+ PRIMARY KEY (day, song_id));
+""")
+
+daily_artist_plays_create = ("""
+CREATE TABLE daily_artist_plays
+(day date, 
+ artist_id varchar, 
+ plays bigint NOT NULL, 
+ PRIMARY KEY (day, artist_id));
+""")
+
+# CREATE INDEXES
+
+song_title_duration_index = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration);"
+artist_name_index = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name);"
+# recent activity per user and plays per song, on a partitioned songplays every partition gets them
+songplay_user_time_index = "CREATE INDEX IF NOT EXISTS songplays_user_id_start_time_idx ON songplays (user_id, start_time);"
+songplay_song_index = "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id);"
+
+# FOREIGN KEYS
+
+# added after the tables are created, or once the bulk load is done in bootstrap mode
+songplay_foreign_keys = ("""
+ALTER TABLE songplays
+ ADD CONSTRAINT songplays_start_time_fkey FOREIGN KEY (start_time) REFERENCES time(start_time) ON DELETE RESTRICT,
+ ADD CONSTRAINT songplays_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE RESTRICT,
+ ADD CONSTRAINT songplays_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs(song_id) ON DELETE RESTRICT,
+ ADD CONSTRAINT songplays_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists(artist_id) ON DELETE RESTRICT;
+""")
+
+# BOOTSTRAP
+
+# true while the star tables are still unlogged from `create_tables.py --bootstrap`
+bootstrap_select = "SELECT relpersistence = 'u' FROM pg_class WHERE relname = 'users';"
+
+# star tables and songplays partitions still unlogged
+unlogged_tables_select = ("""
+SELECT c.relname FROM pg_class c
+WHERE c.relpersistence = 'u' AND c.relkind = 'r'
+AND (c.relname IN ('users', 'songs', 'artists', 'time', 'songplays')
+     OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'songplays'::regclass));
+""")
+
+set_logged_table = "ALTER TABLE {} SET LOGGED;"
+
+partitioned_select = "SELECT relkind = 'p' FROM pg_class WHERE relname = 'songplays';"
+
+analyze_tables = "ANALYZE users, songs, artists, time, songplays;"
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
 INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, 
                        session_id, location, user_agent)
 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (songplay_id) 
-DO NOTHING;
+ON CONFLICT DO NOTHING;
 """)
 
 user_table_insert = ("""
@@ -98,6 +291,171 @@ ON CONFLICT (start_time)
 DO NOTHING;
 """)
 
+# BULK LOAD RECORDS
+
+time_staging_copy = ("""
+COPY time_staging (start_time, hour, day, week, month, year, weekday)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+user_staging_copy = ("""
+COPY users_staging (user_id, first_name, last_name, gender, level)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+time_table_merge = ("""
+INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday FROM time_staging
+ON CONFLICT (start_time) 
+DO NOTHING;
+""")
+
+user_table_merge = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level FROM users_staging
+ON CONFLICT (user_id) DO UPDATE 
+SET level=excluded.level;
+""")
+
+song_staging_copy = ("""
+COPY songs_staging (song_id, title, artist_id, year, duration)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+artist_staging_copy = ("""
+COPY artists_staging (artist_id, name, location, latitude, longitude)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+song_table_merge = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+SELECT song_id, title, artist_id, year, duration FROM songs_staging
+ON CONFLICT (song_id) 
+DO NOTHING;
+""")
+
+artist_table_merge = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+SELECT artist_id, name, location, latitude, longitude FROM artists_staging
+ON CONFLICT (artist_id) 
+DO NOTHING;
+""")
+
+songplay_staging_copy = ("""
+COPY songplays_staging (songplay_id, start_time, user_id, level, song, artist, length, 
+                        session_id, location, user_agent)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+songplay_staging_resolved_copy = ("""
+COPY songplays_staging (songplay_id, start_time, user_id, level, song, artist, length, 
+                        session_id, location, user_agent, song_id, artist_id)
+FROM STDIN WITH (FORMAT csv, NULL '\\N');
+""")
+
+songplay_table_merge = ("""
+INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, 
+                       session_id, location, user_agent)
+SELECT st.songplay_id, st.start_time, st.user_id, st.level, sa.song_id, sa.artist_id, 
+       st.session_id, st.location, st.user_agent
+FROM songplays_staging st
+LEFT JOIN (SELECT songs.song_id, songs.title, songs.duration, artists.artist_id, artists.name FROM songs
+           JOIN artists ON songs.artist_id=artists.artist_id) sa
+ON sa.title=st.song AND sa.name=st.artist AND sa.duration=st.length
+ON CONFLICT DO NOTHING;
+""")
+
+songplay_table_resolved_merge = ("""
+INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, 
+                       session_id, location, user_agent)
+SELECT songplay_id, start_time, user_id, level, song_id, artist_id, 
+       session_id, location, user_agent
+FROM songplays_staging
+ON CONFLICT DO NOTHING;
+""")
+
+staging_truncate = "TRUNCATE time_staging, users_staging, songplays_staging;"
+song_staging_truncate = "TRUNCATE songs_staging, artists_staging;"
+
+# CHECKPOINTS
+
+checkpoint_select = "SELECT loaded_file FROM etl_checkpoint WHERE data_path=%s;"
+
+checkpoint_insert = ("""
+INSERT INTO etl_checkpoint (data_path, loaded_file)
+SELECT %s, unnest(%s::varchar[])
+ON CONFLICT DO NOTHING;
+""")
+
+checkpoint_delete = "DELETE FROM etl_checkpoint WHERE data_path=%s;"
+
+# MANIFEST
+
+manifest_select = "SELECT path, size, mtime, content_hash FROM etl_manifest;"
+
+manifest_upsert = ("""
+INSERT INTO etl_manifest (path, size, mtime, content_hash)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (path) DO UPDATE 
+SET size=excluded.size, mtime=excluded.mtime, content_hash=excluded.content_hash, loaded_at=now();
+""")
+
+# AGGREGATE REFRESH
+
+# start_time is in epoch milliseconds, days are UTC
+songplay_day = "(to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')::date"
+
+# runs before daily_user_plays is updated, so users already active that day are not counted twice
+daily_active_users_refresh = ("""
+INSERT INTO daily_active_users (day, active_users, plays)
+SELECT d.day, 
+       count(*) FILTER (WHERE NOT EXISTS (SELECT 1 FROM daily_user_plays u
+                                         WHERE u.day = d.day AND u.user_id = d.user_id)), 
+       sum(d.plays)
+FROM (SELECT {day} AS day, user_id, count(*) AS plays
+      FROM songplays_delta GROUP BY 1, 2) d
+GROUP BY d.day
+ON CONFLICT (day) DO UPDATE 
+SET active_users = daily_active_users.active_users + EXCLUDED.active_users, 
+    plays = daily_active_users.plays + EXCLUDED.plays;
+""").format(day=songplay_day)
+
+daily_user_plays_refresh = ("""
+INSERT INTO daily_user_plays (day, user_id, plays)
+SELECT {day}, user_id, count(*) FROM songplays_delta GROUP BY 1, 2
+ON CONFLICT (day, user_id) DO UPDATE 
+SET plays = daily_user_plays.plays + EXCLUDED.plays;
+""").format(day=songplay_day)
+
+daily_level_plays_refresh = ("""
+INSERT INTO daily_level_plays (day, level, plays)
+SELECT {day}, level, count(*) FROM songplays_delta GROUP BY 1, 2
+ON CONFLICT (day, level) DO UPDATE 
+SET plays = daily_level_plays.plays + EXCLUDED.plays;
+""").format(day=songplay_day)
+
+daily_song_plays_refresh = ("""
+INSERT INTO daily_song_plays (day, song_id, plays)
+SELECT {day}, song_id, count(*) FROM songplays_delta WHERE song_id IS NOT NULL GROUP BY 1, 2
+ON CONFLICT (day, song_id) DO UPDATE 
+SET plays = daily_song_plays.plays + EXCLUDED.plays;
+""").format(day=songplay_day)
+
+daily_artist_plays_refresh = ("""
+INSERT INTO daily_artist_plays (day, artist_id, plays)
+SELECT {day}, artist_id, count(*) FROM songplays_delta WHERE artist_id IS NOT NULL GROUP BY 1, 2
+ON CONFLICT (day, artist_id) DO UPDATE 
+SET plays = daily_artist_plays.plays + EXCLUDED.plays;
+""").format(day=songplay_day)
+
+# sinks without triggers (DuckDB) capture the new songplays from the songplays merges instead:
+# the merge returns the rows it inserted as songplays_new, existing songplays being skipped by
+# ON CONFLICT through the primary key
+songplay_delta_capture = "INSERT INTO songplays_delta SELECT * FROM songplays_new;"
+
+songplay_delta_count = "SELECT count(*) FROM songplays_delta;"
+songplay_delta_truncate = "TRUNCATE songplays_delta;"
+
 # FIND SONGS
 
 song_select = ("""
@@ -106,7 +464,43 @@ JOIN artists ON songs.artist_id=artists.artist_id
 WHERE songs.title=%s AND artists.name=%s AND songs.duration=%s; 
 """)
 
+song_lookup_select = ("""
+SELECT songs.title, artists.name, songs.duration, songs.song_id, artists.artist_id FROM songs
+JOIN artists ON songs.artist_id=artists.artist_id;
+""")
+
+# PREPARED STATEMENTS
+
+# per-row statements that can be prepared once per connection, by statement name
+prepared_statements = {
+    'songplay_insert': songplay_table_insert,
+    'user_insert': user_table_insert,
+    'song_insert': song_table_insert,
+    'artist_insert': artist_table_insert,
+    'time_insert': time_table_insert,
+    'song_select': song_select
+}
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+star_table_create_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
+staging_table_create_queries = [time_staging_create, user_staging_create, songplay_staging_create,
+                                song_staging_create, artist_staging_create,
+                                checkpoint_table_create, manifest_table_create]
+aggregate_table_create_queries = [songplay_delta_create, songplay_capture_create, daily_active_users_create,
+                                  daily_user_plays_create, daily_level_plays_create, daily_song_plays_create,
+                                  daily_artist_plays_create]
+create_table_queries = star_table_create_queries + staging_table_create_queries + aggregate_table_create_queries
+drop_table_queries = [songplay_capture_drop, songplay_delta_drop, daily_active_users_drop, daily_user_plays_drop,
+                      daily_level_plays_drop, daily_song_plays_drop, daily_artist_plays_drop,
+                      songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+                      time_staging_drop, user_staging_drop, songplay_staging_drop,
+                      song_staging_drop, artist_staging_drop,
+                      checkpoint_table_drop, manifest_table_drop]
+lookup_index_queries = [song_title_duration_index, artist_name_index]
+songplay_index_queries = [songplay_user_time_index, songplay_song_index]
+create_index_queries = lookup_index_queries + songplay_index_queries
+create_constraint_queries = [songplay_foreign_keys]
+# daily_active_users has to be refreshed before daily_user_plays
+aggregate_refresh_queries = [daily_active_users_refresh, daily_user_plays_refresh, daily_level_plays_refresh,
+                             daily_song_plays_refresh, daily_artist_plays_refresh]
\ No newline at end of file
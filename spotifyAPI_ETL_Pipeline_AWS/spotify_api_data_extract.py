@@ -1,25 +1,106 @@
-import json
 import os
+import json
+import gzip
+import time
+import random
+import requests
 import spotipy
+from urllib3.util.retry import Retry
 from spotipy.oauth2 import SpotifyClientCredentials
 import boto3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from io import BytesIO
+
+BUCKET = "spotify-etl-project-divakar"
+TO_PROCESS_PREFIX = "raw_data/to_processed/"
+# comma separated playlist links, URIs or IDs
+PLAYLISTS = os.environ.get('playlists', 'https://open.spotify.com/playlist/37i9dQZEVXbNG2KDcFcKOF?si=1333723a6eff4b7f')
+# playlist_items returns at most 100 items per page
+PAGE_SIZE = 100
+# pages requested at the same time
+MAX_REQUESTS = int(os.environ.get('max_requests', 8))
+MAX_RETRIES = int(os.environ.get('max_retries', 5))
+# longest wait before retrying a rate limited page, however long Retry-After asks for
+MAX_RETRY_DELAY = float(os.environ.get('max_retry_delay', 30))
+
+def spotify_client():
+    # spotify_api_url and access_token point the client at a local stub of the Web API
+    access_token = os.environ.get('access_token')
+    client_credentials_manager = None
+    if not access_token:
+        client_credentials_manager = SpotifyClientCredentials(client_id=os.environ.get('client_id'),
+                                                              client_secret=os.environ.get('client_secret'))
+    # server errors are retried by the session, 429 is not: urllib3 would otherwise sleep for
+    # Retry-After itself, so fetch_page backs off on it with a capped delay
+    session = requests.Session()
+    retry = Retry(total=3, connect=None, read=False, status=3, backoff_factor=0.3,
+                  status_forcelist=(500, 502, 503, 504), respect_retry_after_header=False)
+    session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retry))
+    session.mount('http://', requests.adapters.HTTPAdapter(max_retries=retry))
+    sp = spotipy.Spotify(auth=access_token, client_credentials_manager=client_credentials_manager,
+                         requests_session=session)
+    sp.prefix = os.environ.get('spotify_api_url', sp.prefix)
+    return sp
+
+def playlist_id(link):
+    # accepts https://open.spotify.com/playlist/<id>?si=..., spotify:playlist:<id> or the bare id
+    return link.strip().split('/')[-1].split('?')[0].split(':')[-1]
+
+def retry_delay(error, attempt):
+    # Spotify sends the seconds to wait in Retry-After, otherwise back off exponentially with jitter
+    retry_after = (error.headers or {}).get('Retry-After')
+    if retry_after is not None:
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    return min(2 ** attempt, MAX_RETRY_DELAY) * (0.5 + random.random() / 2)
+
+def fetch_page(sp, playlist, offset, max_retries=MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            return sp.playlist_items(playlist, limit=PAGE_SIZE, offset=offset, additional_types=('track',))
+        except spotipy.SpotifyException as e:
+            if e.http_status != 429 or attempt == max_retries:
+                raise
+            time.sleep(retry_delay(e, attempt))
+
+def iter_pages(sp, playlists, max_requests=MAX_REQUESTS):
+    # yields (playlist, page) as pages arrive; the first page of each playlist gives its total,
+    # then its remaining pages are requested concurrently
+    with ThreadPoolExecutor(max_workers=max_requests) as executor:
+        pending = {executor.submit(fetch_page, sp, playlist, 0): (playlist, 0) for playlist in playlists}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                playlist, offset = pending.pop(future)
+                page = future.result()
+                if offset == 0:
+                    for next_offset in range(PAGE_SIZE, page['total'], PAGE_SIZE):
+                        pending[executor.submit(fetch_page, sp, playlist, next_offset)] = (playlist, next_offset)
+                yield playlist, page
+
+def write_ndjson(pages):
+    # one playlist item per line, tagged with its playlist and position, compressed as it is written
+    buffer = BytesIO()
+    count = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+        for playlist, page in pages:
+            for position, item in enumerate(page['items'], start=page['offset']):
+                item['playlist_id'] = playlist
+                item['position'] = position
+                f.write(json.dumps(item).encode() + b"\n")
+                count += 1
+    return buffer.getvalue(), count
+
+def lambda_handler(event, context, sp=None):
+    sp = sp or spotify_client()
+    playlists = [playlist_id(link) for link in PLAYLISTS.split(',') if link.strip()]
+    body, count = write_ndjson(iter_pages(sp, playlists))
 
-def lambda_handler(event, context):
-    client_id = os.environ.get('client_id')
-    client_secret = os.environ.get('client_secret')
-    client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-    
-    playlists = sp.user_playlists('spotify')
-    playlist_link = 'https://open.spotify.com/playlist/37i9dQZEVXbNG2KDcFcKOF?si=1333723a6eff4b7f'
-    playlist_uri = playlist_link.split('/')[-1].split('?')[0]
-    spotify_data = sp.playlist_tracks(playlist_uri)
-    
     client = boto3.client('s3')
-    filename = "spotify_raw" + str(datetime.now()) + ".json"
+    filename = "spotify_raw" + str(datetime.now()) + ".json.gz"
     client.put_object(
-        Bucket = "spotify-etl-project-divakar",
-        Key = "raw_data/to_processed/" + filename,
-        Body = json.dumps(spotify_data)
-        )
\ No newline at end of file
+        Bucket = BUCKET,
+        Key = TO_PROCESS_PREFIX + filename,
+        Body = body
+        )
+    return {'playlists': len(playlists), 'items': count, 'key': TO_PROCESS_PREFIX + filename}
\ No newline at end of file
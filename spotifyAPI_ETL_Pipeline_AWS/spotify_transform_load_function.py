@@ -1,105 +1,226 @@
+import os
+import re
 import json
+import gzip
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from io import StringIO
+from io import StringIO, BytesIO
 import pandas as pd
 
-def album(data):
-    album_list = []
-    for row in data['items']:
-        album_id = row['track']['album']['id']
-        album_name = row['track']['album']['name']
-        album_release_date = row['track']['album']['release_date']
-        album_total_tracks = row['track']['album']['total_tracks']
-        album_url = row['track']['album']['external_urls']['spotify']
-        album_element = {'album_id':album_id,'name':album_name,'release_date':album_release_date,
-                            'total_tracks':album_total_tracks,'url':album_url}
-        album_list.append(album_element)
-    return album_list
-    
-def artist(data):
-    artist_list = []
-    for row in data['items']:
-        for key, value in row.items():
-            if key == "track":
-                for artist in value['artists']:
-                    artist_dict = {'artist_id':artist['id'], 'artist_name':artist['name'], 'external_url': artist['href']}
-                    artist_list.append(artist_dict)
-    return artist_list
-    
-def song(data):
-    song_list = []
+BUCKET = "spotify-etl-project-divakar"
+TO_PROCESS_PREFIX = "raw_data/to_processed/"
+PROCESSED_PREFIX = "raw_data/processed/"
+# raw snapshots downloaded at the same time, also the most held in memory
+MAX_DOWNLOADS = int(os.environ.get('max_downloads', 8))
+# csv, or parquet partitioned by snapshot date
+OUTPUT_FORMAT = os.environ.get('output_format', 'csv')
+PARQUET_COMPRESSION = os.environ.get('parquet_compression', 'snappy')
+# raw snapshots copied to the processed prefix at the same time
+MAX_COPIES = int(os.environ.get('max_copies', 16))
+# delete_objects removes at most 1,000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+# output columns of each entity, filled for a whole batch of snapshots before building the frames
+ENTITY_COLUMNS = {
+    'album': ['album_id', 'name', 'release_date', 'total_tracks', 'url'],
+    'artist': ['artist_id', 'artist_name', 'external_url'],
+    'song': ['song_id', 'song_name', 'duration_ms', 'url', 'popularity', 'song_added', 'album_id', 'artist_id']
+}
+
+def new_columns():
+    # every row also records the key of its snapshot, to deduplicate independently of download order
+    return {entity: {column: [] for column in columns + ['snapshot_key']}
+            for entity, columns in ENTITY_COLUMNS.items()}
+
+def extract_entities(data, columns, snapshot_key):
+    # one pass over the items appends the album, artists and song of every track to the columns
+    album, artist, song = columns['album'], columns['artist'], columns['song']
     for row in data['items']:
-        song_id = row['track']['id']
-        song_name = row['track']['name']
-        song_duration = row['track']['duration_ms']
-        song_url = row['track']['external_urls']['spotify']
-        song_popularity = row['track']['popularity']
-        song_added = row['added_at']
-        album_id = row['track']['album']['id']
-        artist_id = row['track']['album']['artists'][0]['id']
-        song_element = {'song_id':song_id,'song_name':song_name,'duration_ms':song_duration,'url':song_url,
-                        'popularity':song_popularity,'song_added':song_added,'album_id':album_id,
-                        'artist_id':artist_id
-                       }
-        song_list.append(song_element)
-    return song_list
+        track = row['track']
+        if track is None:
+            # tracks removed from Spotify stay in playlists without their details
+            continue
+        track_album = track['album']
+        album['snapshot_key'].append(snapshot_key)
+        song['snapshot_key'].append(snapshot_key)
+
+        album['album_id'].append(track_album['id'])
+        album['name'].append(track_album['name'])
+        album['release_date'].append(track_album['release_date'])
+        album['total_tracks'].append(track_album['total_tracks'])
+        album['url'].append(track_album['external_urls']['spotify'])
+
+        for track_artist in track['artists']:
+            artist['snapshot_key'].append(snapshot_key)
+            artist['artist_id'].append(track_artist['id'])
+            artist['artist_name'].append(track_artist['name'])
+            artist['external_url'].append(track_artist['href'])
+
+        song['song_id'].append(track['id'])
+        song['song_name'].append(track['name'])
+        song['duration_ms'].append(track['duration_ms'])
+        song['url'].append(track['external_urls']['spotify'])
+        song['popularity'].append(track['popularity'])
+        song['song_added'].append(row['added_at'])
+        song['album_id'].append(track_album['id'])
+        song['artist_id'].append(track_album['artists'][0]['id'])
+
+def snapshot_date(key):
+    # raw files are named spotify_raw<datetime>.json(.gz) by the extract function
+    match = re.search(r'\d{4}-\d{2}-\d{2}', key.split("/")[-1])
+    return match.group(0) if match else datetime.now().strftime('%Y-%m-%d')
+
+def dedupe(columns, key):
+    # duplicates are dropped within each snapshot date, so every date keeps all of its snapshots'
+    # entities; rows stay in snapshot order, the latest snapshot of a date wins
+    df = pd.DataFrame(columns).sort_values('snapshot_key', kind='stable')
+    df['snapshot_date'] = [snapshot_date(snapshot_key) for snapshot_key in df.pop('snapshot_key')]
+    return df.drop_duplicates([key, 'snapshot_date'], keep='last').reset_index(drop=True)
+
+def build_frames(columns):
+    album_df = dedupe(columns['album'], 'album_id')
+    artist_df = dedupe(columns['artist'], 'artist_id')
+    song_df = dedupe(columns['song'], 'song_id')
+
+    # release dates come as YYYY, YYYY-MM or YYYY-MM-DD depending on their precision
+    album_df['release_date'] = pd.to_datetime(album_df['release_date'], format='ISO8601')
+    album_df['total_tracks'] = album_df['total_tracks'].astype('Int64')
+    song_df['song_added'] = pd.to_datetime(song_df['song_added'], format='ISO8601')
+    song_df['duration_ms'] = song_df['duration_ms'].astype('Int64')
+    song_df['popularity'] = song_df['popularity'].astype('Int64')
+    return album_df, artist_df, song_df
+
+def list_raw_keys(s3, bucket, prefix):
+    # list_objects returns at most 1,000 keys per call, the paginator follows continuation tokens
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for file in page.get('Contents', []):
+            if file['Key'].endswith((".json", ".json.gz")):
+                yield file['Key']
+
+def download_snapshot(s3, bucket, key):
+    response = s3.get_object(Bucket=bucket, Key=key)
+    if key.endswith(".gz"):
+        # gzip compressed NDJSON from the extract function, one playlist item per line
+        return {'items': [json.loads(line) for line in gzip.decompress(response['Body'].read()).splitlines()]}
+    return json.loads(response['Body'].read())
+
+def iter_snapshots(s3, bucket, keys, max_downloads=MAX_DOWNLOADS):
+    # yields (key, data) as downloads complete, with at most max_downloads requests in flight
+    with ThreadPoolExecutor(max_workers=max_downloads) as executor:
+        pending = {}
+        for key in keys:
+            pending[executor.submit(download_snapshot, s3, bucket, key)] = key
+            if len(pending) >= max_downloads:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+def put_csv(s3, bucket, prefix, name, df, key):
+    # the CSV files have no snapshot date, each entity is written once, from the latest snapshot
+    buffer = StringIO()
+    df.drop_duplicates(key, keep='last').drop(columns='snapshot_date').to_csv(buffer, index=False)
+    s3.put_object(Bucket=bucket, Key=prefix + name + ".csv", Body=buffer.getvalue())
+
+def put_parquet(s3, bucket, prefix, name, df, key):
+    # one file per snapshot date, in Hive style snapshot_date=YYYY-MM-DD partitions
+    for date, partition in df.groupby('snapshot_date'):
+        buffer = BytesIO()
+        partition.drop(columns='snapshot_date').to_parquet(buffer, index=False, compression=PARQUET_COMPRESSION)
+        s3.put_object(Bucket=bucket, Key=prefix + "snapshot_date=" + date + "/" + name + ".parquet",
+                      Body=buffer.getvalue())
+
+def write_frames(s3, bucket, album_df, artist_df, song_df):
+    put = put_parquet if OUTPUT_FORMAT == 'parquet' else put_csv
+    put(s3, bucket, "transformed_data/songs_data/", "songs_transformed_" + str(datetime.now()), song_df, 'song_id')
+    put(s3, bucket, "transformed_data/album_data/", "album_transformed_" + str(datetime.now()), album_df, 'album_id')
+    put(s3, bucket, "transformed_data/artist_data/", "artist_transformed_" + str(datetime.now()), artist_df, 'artist_id')
+
+def archived_key(key):
+    return PROCESSED_PREFIX + key.split("/")[-1]
+
+def copy_snapshot(s3, bucket, key):
+    s3.copy_object(Bucket=bucket, Key=archived_key(key), CopySource={'Bucket': bucket, 'Key': key})
+
+def original_exists(s3, bucket, key):
+    # None when it cannot be told whether the key still exists
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        return None
+    except BotoCoreError:
+        return None
+
+def delete_keys(s3, bucket, keys):
+    # returns the error message of every key that could not be deleted
+    errors = {}
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i:i + DELETE_BATCH_SIZE]
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        except (ClientError, BotoCoreError) as e:
+            # a failed call may or may not have deleted the batch, every key of it counts as not deleted
+            errors.update({key: str(e) for key in batch})
+            continue
+        for error in response.get('Errors', []):
+            errors[error['Key']] = error['Code'] + ": " + error['Message']
+    return errors
+
+def archive_keys(s3, bucket, keys, max_copies=MAX_COPIES):
+    # copies every key to the processed prefix concurrently, then deletes the originals in batches;
+    # a key whose original cannot be deleted has its copy removed again, so it stays unprocessed only
+    failures = {}
+    copied = []
+    with ThreadPoolExecutor(max_workers=max_copies) as executor:
+        futures = {executor.submit(copy_snapshot, s3, bucket, key): key for key in keys}
+        for future, key in futures.items():
+            try:
+                future.result()
+                copied.append(key)
+            except (ClientError, BotoCoreError) as e:
+                failures[key] = "copy failed, " + str(e)
+
+        not_deleted = delete_keys(s3, bucket, copied)
+        # a delete_objects call that raised may still have deleted some originals, those are archived;
+        # the copies of the others are removed, unless it cannot be told whether the original is still there
+        exists = dict(zip(not_deleted, executor.map(lambda key: original_exists(s3, bucket, key), not_deleted)))
+
+    rollback = [key for key in not_deleted if exists[key]]
+    rollback_errors = delete_keys(s3, bucket, [archived_key(key) for key in rollback])
+    for key in rollback:
+        failures[key] = "delete failed, " + not_deleted[key]
+        if archived_key(key) in rollback_errors:
+            failures[key] += ", and its archived copy could not be removed: " + rollback_errors[archived_key(key)]
+    for key in not_deleted:
+        if exists[key] is None:
+            failures[key] = "delete failed, " + not_deleted[key] + ", archived copy kept as the original could not be checked"
+    return failures
 
 def lambda_handler(event, context):
     s3 = boto3.client('s3')
-    Bucket = "spotify-etl-project-divakar"
-    Key = "raw_data/to_processed/"
+    Bucket = BUCKET
+    Key = TO_PROCESS_PREFIX
     
-    spotify_data = []
+    # each snapshot is extracted as soon as its download completes, the batch is written once
+    columns = new_columns()
     spotify_keys = []
-    for file in s3.list_objects(Bucket=Bucket, Prefix = Key)['Contents']:
-        file_key = file['Key']
-        if file_key.split(".")[-1] == "json":
-            response = s3.get_object(Bucket = Bucket, Key = file_key)
-            content = response['Body']
-            jsonObject = json.loads(content.read())
-            spotify_data.append(jsonObject)
-            spotify_keys.append(file_key)
-    for data in spotify_data:
-        album_list = album(data)
-        artist_list = artist(data)
-        song_list = song(data)
-        
-        album_df = pd.DataFrame(album_list)
-        album_df = album_df.drop_duplicates('album_id')
-        
-        artist_df = pd.DataFrame(artist_list)
-        artist_df = artist_df.drop_duplicates('artist_id')
-        
-        song_df = pd.DataFrame(song_list)
-        song_df = song_df.drop_duplicates('song_id')
-        
-        album_df['release_date'] = pd.to_datetime(album_df['release_date'])
-        song_df['song_added'] = pd.to_datetime(song_df['song_added'])
-    
-        songs_key = "transformed_data/songs_data/songs_transformed_" + str(datetime.now()) + ".csv"
-        song_buffer=StringIO()
-        song_df.to_csv(song_buffer, index=False)
-        song_content = song_buffer.getvalue()
-        s3.put_object(Bucket=Bucket, Key=songs_key, Body=song_content)
-        
-        album_key = "transformed_data/album_data/album_transformed_" + str(datetime.now()) + ".csv"
-        album_buffer=StringIO()
-        album_df.to_csv(album_buffer, index=False)
-        album_content = album_buffer.getvalue()
-        s3.put_object(Bucket=Bucket, Key=album_key, Body=album_content)
-        
-        artist_key = "transformed_data/artist_data/artist_transformed_" + str(datetime.now()) + ".csv"
-        artist_buffer=StringIO()
-        artist_df.to_csv(artist_buffer, index=False)
-        artist_content = artist_buffer.getvalue()
-        s3.put_object(Bucket=Bucket, Key=artist_key, Body=artist_content)
-
-    s3_resource = boto3.resource('s3')
-    for key in spotify_keys:
-        copy_source = {
-            'Bucket': Bucket,
-            'Key': key
-        }
-        s3_resource.meta.client.copy(copy_source, Bucket, 'raw_data/processed/' + key.split("/")[-1])    
-        s3_resource.Object(Bucket, key).delete()
\ No newline at end of file
+    for file_key, data in iter_snapshots(s3, Bucket, list_raw_keys(s3, Bucket, Key)):
+        extract_entities(data, columns, file_key)
+        spotify_keys.append(file_key)
+
+    if spotify_keys:
+        write_frames(s3, Bucket, *build_frames(columns))
+
+    failures = archive_keys(s3, Bucket, spotify_keys)
+    for key, error in failures.items():
+        print("Could not archive " + key + ": " + error)
+    return {'processed': len(spotify_keys), 'archived': len(spotify_keys) - len(failures), 'failed': failures}
\ No newline at end of file
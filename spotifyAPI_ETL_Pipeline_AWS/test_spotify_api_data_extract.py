@@ -0,0 +1,100 @@
+import os
+import json
+import gzip
+import threading
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import spotify_api_data_extract as extract
+
+# playlist id -> number of items served by the stub
+PLAYLIST_SIZES = {'playlistA': 250, 'playlistB': 40}
+
+def playlist_item(playlist, position):
+    artist = {'id': 'artist' + str(position), 'name': 'Artist', 'href': 'https://api.spotify.com/v1/artists/x'}
+    return {
+        'added_at': '2024-07-01T10:00:00Z',
+        'track': {
+            'id': playlist + '-' + str(position), 'name': 'Song', 'duration_ms': 200000, 'popularity': 50,
+            'external_urls': {'spotify': 'https://open.spotify.com/track/x'}, 'artists': [artist],
+            'album': {'id': 'album' + str(position), 'name': 'Album', 'release_date': '2024', 'total_tracks': 10,
+                      'external_urls': {'spotify': 'https://open.spotify.com/album/x'}, 'artists': [artist]}
+        }
+    }
+
+class StubSpotifyAPI(BaseHTTPRequestHandler):
+    # serves GET /v1/playlists/<id>/items pages, answering the first request for offset 100 with a 429
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        playlist = url.path.split('/')[-2]
+        offset, limit = int(query['offset'][0]), int(query['limit'][0])
+        with self.lock:
+            attempt = self.requests.count((playlist, offset))
+            self.requests.append((playlist, offset))
+
+        if offset == 100 and attempt == 0:
+            self.respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': '1'})
+            return
+        total = PLAYLIST_SIZES[playlist]
+        items = [playlist_item(playlist, position) for position in range(offset, min(offset + limit, total))]
+        self.respond(200, {'items': items, 'offset': offset, 'limit': limit, 'total': total})
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+class ExtractTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubSpotifyAPI)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubSpotifyAPI.requests.clear()
+        env = {'access_token': 'stub', 'spotify_api_url': 'http://127.0.0.1:{}/v1/'.format(self.server.server_port)}
+        with mock.patch.dict(os.environ, env):
+            self.sp = extract.spotify_client()
+
+    def test_playlist_id(self):
+        self.assertEqual(extract.playlist_id('https://open.spotify.com/playlist/37i9dQZEVXbNG2KDcFcKOF?si=1333723a6eff4b7f'),
+                         '37i9dQZEVXbNG2KDcFcKOF')
+        self.assertEqual(extract.playlist_id(' spotify:playlist:37i9dQZEVXbNG2KDcFcKOF'), '37i9dQZEVXbNG2KDcFcKOF')
+
+    def test_fetches_every_page_into_gzip_ndjson(self):
+        with mock.patch.object(extract.time, 'sleep') as sleep:
+            body, count = extract.write_ndjson(extract.iter_pages(self.sp, list(PLAYLIST_SIZES)))
+
+        lines = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        self.assertEqual(count, sum(PLAYLIST_SIZES.values()))
+        self.assertEqual(sorted((item['playlist_id'], item['position']) for item in lines),
+                         sorted((playlist, position) for playlist, size in PLAYLIST_SIZES.items() for position in range(size)))
+        self.assertTrue(all(item['track']['id'] == '{}-{}'.format(item['playlist_id'], item['position']) for item in lines))
+
+        # the rate limited page was requested twice, after waiting for Retry-After once
+        self.assertEqual(sorted(StubSpotifyAPI.requests),
+                         [('playlistA', 0), ('playlistA', 100), ('playlistA', 100), ('playlistA', 200), ('playlistB', 0)])
+        sleep.assert_called_once_with(1.0)
+
+    def test_retry_delay_is_capped(self):
+        error = extract.spotipy.SpotifyException(429, -1, 'API rate limit exceeded', headers={'Retry-After': '3600'})
+        self.assertEqual(extract.retry_delay(error, 0), extract.MAX_RETRY_DELAY)
+
+if __name__ == '__main__':
+    unittest.main()
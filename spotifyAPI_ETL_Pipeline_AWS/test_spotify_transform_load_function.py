@@ -0,0 +1,172 @@
+import os
+import json
+import gzip
+import unittest
+from io import StringIO
+from unittest import mock
+import boto3
+import pandas as pd
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_aws
+import spotify_transform_load_function as transform
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+def playlist_item(song, album, artist):
+    track_artist = {'id': artist, 'name': 'Artist ' + artist, 'href': 'https://api.spotify.com/v1/artists/' + artist}
+    return {
+        'added_at': '2024-07-01T10:00:00Z',
+        'track': {
+            'id': song, 'name': 'Song ' + song, 'duration_ms': 200000, 'popularity': 50,
+            'external_urls': {'spotify': 'https://open.spotify.com/track/' + song}, 'artists': [track_artist],
+            'album': {'id': album, 'name': 'Album ' + album, 'release_date': '2024-05', 'total_tracks': 10,
+                      'external_urls': {'spotify': 'https://open.spotify.com/album/' + album}, 'artists': [track_artist]}
+        }
+    }
+
+def raw_key(name):
+    return transform.TO_PROCESS_PREFIX + name
+
+@mock_aws
+class TransformLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket=transform.BUCKET)
+
+    def put_keys(self, count):
+        keys = [raw_key('spotify_raw2024-07-01 10:00:00.{:06d}.json'.format(i)) for i in range(count)]
+        for key in keys:
+            self.s3.put_object(Bucket=transform.BUCKET, Key=key, Body=b'{"items": []}')
+        return keys
+
+    def list_keys(self, prefix):
+        return {file['Key'].split("/")[-1]
+                for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=transform.BUCKET, Prefix=prefix)
+                for file in page.get('Contents', [])}
+
+    def assert_archived(self, keys, failed):
+        # every key is either archived or still to be processed, never both
+        processed = self.list_keys(transform.PROCESSED_PREFIX)
+        to_process = self.list_keys(transform.TO_PROCESS_PREFIX)
+        names = {key.split("/")[-1] for key in keys}
+        self.assertEqual(to_process, {key.split("/")[-1] for key in failed})
+        self.assertEqual(processed, names - to_process)
+
+    def test_lists_raw_keys_past_one_page(self):
+        keys = self.put_keys(1005)
+        self.s3.put_object(Bucket=transform.BUCKET, Key=raw_key('spotify_raw2024-07-02 10:00:00.000000.json.gz'), Body=b'')
+        self.s3.put_object(Bucket=transform.BUCKET, Key=raw_key('notes.txt'), Body=b'')
+
+        listed = list(transform.list_raw_keys(self.s3, transform.BUCKET, transform.TO_PROCESS_PREFIX))
+        self.assertEqual(len(listed), 1006)
+        self.assertEqual(set(listed), set(keys) | {raw_key('spotify_raw2024-07-02 10:00:00.000000.json.gz')})
+
+    def test_handler_reads_json_and_gzip_ndjson_snapshots(self):
+        json_key = raw_key('spotify_raw2024-07-01 10:00:00.000000.json')
+        gz_key = raw_key('spotify_raw2024-07-02 10:00:00.000000.json.gz')
+        self.s3.put_object(Bucket=transform.BUCKET, Key=json_key,
+                           Body=json.dumps({'items': [playlist_item('s1', 'a1', 'r1'), playlist_item('s2', 'a1', 'r2')]}))
+        lines = [playlist_item('s2', 'a2', 'r2'), playlist_item('s3', 'a2', 'r3'), {'track': None}]
+        self.s3.put_object(Bucket=transform.BUCKET, Key=gz_key,
+                           Body=gzip.compress(b''.join(json.dumps(line).encode() + b"\n" for line in lines)))
+
+        result = transform.lambda_handler({}, None)
+        self.assertEqual(result, {'processed': 2, 'archived': 2, 'failed': {}})
+        self.assert_archived([json_key, gz_key], [])
+
+        songs_key, = [file['Key'] for file in self.s3.list_objects_v2(Bucket=transform.BUCKET, Prefix="transformed_data/songs_data/")['Contents']]
+        songs = pd.read_csv(StringIO(self.s3.get_object(Bucket=transform.BUCKET, Key=songs_key)['Body'].read().decode()))
+        # s2 is in both snapshots, the later one wins
+        self.assertEqual(sorted(songs['song_id']), ['s1', 's2', 's3'])
+        self.assertEqual(songs.set_index('song_id').loc['s2', 'album_id'], 'a2')
+
+    def test_archives_past_one_delete_batch(self):
+        keys = self.put_keys(1005)
+        with mock.patch.object(self.s3, 'delete_objects', wraps=self.s3.delete_objects) as delete_objects:
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        self.assertEqual(failures, {})
+        self.assertEqual([len(call.kwargs['Delete']['Objects']) for call in delete_objects.call_args_list], [1000, 5])
+        self.assert_archived(keys, [])
+
+    def test_per_key_delete_error_removes_the_copy(self):
+        keys = self.put_keys(3)
+        delete_objects = self.s3.delete_objects
+
+        def deny_first_key(**kwargs):
+            objects = kwargs['Delete']['Objects']
+            denied = [obj for obj in objects if obj['Key'] == keys[0]]
+            response = delete_objects(Bucket=kwargs['Bucket'], Delete={'Objects': [obj for obj in objects if obj not in denied]})
+            response['Errors'] = [{'Key': obj['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'} for obj in denied]
+            return response
+
+        with mock.patch.object(self.s3, 'delete_objects', side_effect=deny_first_key):
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        self.assertEqual(list(failures), [keys[0]])
+        self.assertIn('AccessDenied', failures[keys[0]])
+        self.assert_archived(keys, [keys[0]])
+
+    def test_raising_delete_call_fails_its_whole_batch(self):
+        keys = self.put_keys(3)
+        delete_objects = self.s3.delete_objects
+        calls = []
+
+        def fail_first_call(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+            return delete_objects(**kwargs)
+
+        with mock.patch.object(self.s3, 'delete_objects', side_effect=fail_first_call):
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        # the originals are still there, so every archived copy of the batch was removed again
+        self.assertEqual(set(failures), set(keys))
+        self.assert_archived(keys, keys)
+
+    def test_raising_delete_call_after_deleting_counts_as_archived(self):
+        keys = self.put_keys(3)
+        delete_objects = self.s3.delete_objects
+
+        def lose_response(**kwargs):
+            delete_objects(**kwargs)
+            raise EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+
+        with mock.patch.object(self.s3, 'delete_objects', side_effect=lose_response):
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        self.assertEqual(failures, {})
+        self.assert_archived(keys, [])
+
+    def test_copy_is_kept_when_the_original_cannot_be_checked(self):
+        keys = self.put_keys(2)
+        with mock.patch.object(self.s3, 'delete_objects', side_effect=EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')), \
+             mock.patch.object(self.s3, 'head_object', side_effect=EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')):
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        self.assertEqual(set(failures), set(keys))
+        self.assertTrue(all('archived copy kept' in error for error in failures.values()))
+        self.assertEqual(self.list_keys(transform.PROCESSED_PREFIX), {key.split("/")[-1] for key in keys})
+        self.assertEqual(self.list_keys(transform.TO_PROCESS_PREFIX), {key.split("/")[-1] for key in keys})
+
+    def test_copy_error_leaves_the_key_unprocessed(self):
+        keys = self.put_keys(3)
+        copy_object = self.s3.copy_object
+
+        def fail_second_key(**kwargs):
+            if kwargs['CopySource']['Key'] == keys[1]:
+                raise EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+            return copy_object(**kwargs)
+
+        with mock.patch.object(self.s3, 'copy_object', side_effect=fail_second_key):
+            failures = transform.archive_keys(self.s3, transform.BUCKET, keys)
+
+        self.assertEqual(list(failures), [keys[1]])
+        self.assertTrue(failures[keys[1]].startswith('copy failed'))
+        self.assert_archived(keys, [keys[1]])
+
+if __name__ == '__main__':
+    unittest.main()